@@ -3,10 +3,34 @@ from datetime import datetime, date, timedelta
 import json
 import os
 import hashlib
+import atexit
+import cProfile
+import marshal
+import pickle
+import pstats
+import selectors
+from collections import deque, namedtuple
+import html
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import queue
+import threading
+import re
+import unicodedata
+from difflib import SequenceMatcher
+import time
+from contextlib import contextmanager
 import csv
-from io import StringIO
+import sqlite3
+import tempfile
+import zipfile
+from io import BytesIO, StringIO, TextIOWrapper
 import pytz
+import numpy as np
+import pandas as pd
 import urllib.parse
+import uuid
 
 # Configuração da página
 st.set_page_config(
@@ -18,10 +42,12 @@ st.set_page_config(
 
 # Tente importar SQLAlchemy com fallback
 try:
-    from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, Text, ForeignKey, UniqueConstraint
+    from sqlalchemy import create_engine, select, insert, update, bindparam, exists, true, case, func, union_all, literal, inspect, text, event, Column, String, Integer, Float, DateTime, Text, ForeignKey, UniqueConstraint, Index
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.orm import sessionmaker
-    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.pool import NullPool
+    from sqlalchemy.exc import IntegrityError, OperationalError
+    from sqlalchemy.dialects import postgresql, sqlite
     SQLALCHEMY_AVAILABLE = True
 except ImportError as e:
     st.error(f"Erro ao importar SQLAlchemy: {e}")
@@ -37,10 +63,250 @@ def get_database_url():
     else:
         return 'sqlite:///gestao.db'
 
+@st.cache_resource
+def criar_engine(database_url):
+    """Um engine (e pool de conexões) por URL e por processo, reaproveitado entre reruns."""
+    return create_engine(database_url)
+
+def get_read_database_url():
+    database_url = os.environ.get('READ_DATABASE_URL')
+    if database_url and database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    return database_url
+
+# Versões por família de dados (versoes_dados): invalidam os caches de todas as instâncias
+FAMILIAS_DADOS = ('clientes', 'escolas', 'produtos', 'estoque')
+CANAL_VERSOES = 'versoes_dados'
+VERSOES_INTERVALO = float(os.environ.get('VERSOES_INTERVALO', '5'))   # segundos entre consultas às versões
+VERSOES_INTERVALO_NOTIFY = 60   # com LISTEN/NOTIFY ativo, a consulta periódica é só uma rede de segurança
+
+def _garantir_versoes(conn):
+    existentes = set(conn.execute(select(VersaoDados.familia)).scalars())
+    faltando = [{'familia': familia, 'versao': 0} for familia in FAMILIAS_DADOS if familia not in existentes]
+    if faltando:
+        conn.execute(insert(VersaoDados), faltando)
+
+def incrementar_versoes(session, *familias):
+    """Incrementa as versões na transação da escrita; no PostgreSQL avisa as outras instâncias no commit."""
+    session.execute(
+        update(VersaoDados).where(VersaoDados.familia.in_(familias)).values(versao=VersaoDados.versao + 1)
+    )
+    if session.get_bind().dialect.name == 'postgresql':
+        for familia in familias:
+            session.execute(select(func.pg_notify(CANAL_VERSOES, familia)))
+    session.info.setdefault('familias_alteradas', set()).update(familias)
+
+def _apos_commit(session):
+    marcar_escrita()
+    pendentes = session.info.pop('replicar_shards', None)
+    if pendentes:
+        try:
+            session.info['vinculos_shards'] = replicar_para_shards(pendentes)
+        except Exception as e:
+            guardar_replicacao_pendente(pendentes, e)
+            st.warning(f"Gravado no banco principal, mas a replicação para os shards falhou: {e}. "
+                       "Ela será refeita por 'Sincronizar Shards' na Administração (ou no próximo início).")
+    if session.info.pop('familias_alteradas', None):
+        get_cache_dados(session.info.get('shard')).invalidar()
+    for entrada in session.info.pop('auditoria_pendente', []):
+        get_gravador_auditoria().registrar(entrada)
+
+def _apos_rollback(session):
+    session.info.pop('familias_alteradas', None)
+    session.info.pop('replicar_shards', None)
+    session.info.pop('auditoria_pendente', None)
+
+# Sharding opcional (SHARD_DATABASE_URLS): pedidos e estoque de cada escola ficam no banco escola_id % N;
+# clientes, escolas e produtos continuam no banco principal e são replicados para todos os shards
+def get_shard_database_urls():
+    urls = [url.strip() for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if url.strip()]
+    return [url.replace('postgres://', 'postgresql://', 1) if url.startswith('postgres://') else url for url in urls]
+
+def shard_da_escola(escola_id):
+    """Índice do shard da escola, ou None sem sharding (tudo no banco principal)."""
+    if not shard_engines or escola_id is None:
+        return None
+    return int(escola_id) % len(shard_engines)
+
+def motores_escolas():
+    """Bancos que guardam dados por escola: os shards, ou só o principal."""
+    return shard_engines or [engine]
+
+@st.cache_resource
+def get_pool_shards():
+    return ThreadPoolExecutor(max_workers=max(len(shard_engines), 1), thread_name_prefix='shard')
+
+def _replicar_shard(shard, linhas, vincular, mesclagens):
+    """Aplica em um shard as linhas de referência do principal, as mesclagens de clientes e os vínculos
+    de estoque, em uma transação."""
+    session = sessoes_shard[shard]()
+    try:
+        familias = set()
+        for modelo, valores in linhas.items():
+            if valores:
+                session.execute(_upsert_pela_chave(shard_engines[shard].dialect.name, modelo.__table__), valores)
+                familias.add(modelo.__tablename__)
+        for principal_id, duplicados_ids in mesclagens:
+            for modelo in (Pedido, PedidoArquivo):
+                session.execute(
+                    update(modelo).where(modelo.cliente_id.in_(duplicados_ids)).values(cliente_id=principal_id)
+                )
+            session.execute(ClienteAgregado.__table__.delete().where(ClienteAgregado.cliente_id.in_(duplicados_ids)))
+            session.execute(Cliente.__table__.delete().where(Cliente.id.in_(duplicados_ids)))
+            familias.add('clientes')
+        vinculos = sum(_vincular_escolas(session, produto_ids, quantidade, shard=shard)
+                       for produto_ids, quantidade in vincular)
+        if familias:
+            incrementar_versoes(session, *familias)
+        session.commit()
+        return vinculos
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def replicar_para_shards(pendentes):
+    """Copia do principal para todos os shards as linhas pendentes ({tabela: ids}, ou None para todas).
+
+    Roda após o commit no principal; retorna quantos vínculos de estoque foram criados nos shards.
+    """
+    modelos = {'clientes': Cliente, 'escolas': Escola, 'produtos': Produto}
+    linhas = {}
+    with engine.connect() as conn:
+        for tabela, modelo in modelos.items():
+            if tabela not in pendentes:
+                continue
+            stmt = select(*modelo.__table__.columns)
+            if pendentes[tabela] is not None:
+                stmt = stmt.where(modelo.id.in_(list(pendentes[tabela])))
+            linhas[modelo] = [dict(linha._mapping) for linha in conn.execute(stmt)]
+    vincular = pendentes.get('vincular', [])
+    mesclagens = pendentes.get('mesclar', [])
+    return sum(get_pool_shards().map(lambda shard: _replicar_shard(shard, linhas, vincular, mesclagens),
+                                     range(len(shard_engines))))
+
+def agendar_replicacao(session, tabela, ids=None):
+    """Marca linhas de clientes, escolas ou produtos para replicar nos shards quando a sessão confirmar."""
+    if shard_engines:
+        pendentes = session.info.setdefault('replicar_shards', {})
+        pendentes.setdefault(tabela, set()).update(ids or [])
+
+def guardar_replicacao_pendente(pendentes, erro):
+    """Guarda no principal uma replicação que falhou, para sincronizar_shards() refazê-la."""
+    tarefa = {chave: sorted(valor) if isinstance(valor, set) else valor for chave, valor in pendentes.items()}
+    try:
+        with engine.begin() as conn:
+            conn.execute(insert(ReplicacaoPendente).values(tarefa=json.dumps(tarefa), erro=str(erro)))
+    except Exception as e:
+        st.error(f"Erro ao guardar a replicação pendente: {e}")
+
+def sincronizar_shards():
+    """Copia todos os clientes, escolas e produtos do principal para os shards e refaz as replicações que
+    falharam (mesclagens de clientes e vínculos de estoque). Retorna quantas replicações pendentes refez."""
+    if not shard_engines:
+        return 0
+    replicar_para_shards({'clientes': None, 'escolas': None, 'produtos': None})
+    with engine.connect() as conn:
+        tarefas = conn.execute(
+            select(ReplicacaoPendente.id, ReplicacaoPendente.tarefa).order_by(ReplicacaoPendente.id)
+        ).all()
+    for tarefa_id, tarefa in tarefas:
+        replicar_para_shards(json.loads(tarefa))
+        with engine.begin() as conn:
+            conn.execute(ReplicacaoPendente.__table__.delete().where(ReplicacaoPendente.id == tarefa_id))
+    return len(tarefas)
+
+def _linhas_da_escola_no_shard(tabela, shard):
+    """Filtro das linhas de uma tabela por escola que pertencem ao shard (itens seguem o pedido)."""
+    total = len(shard_engines)
+    if 'escola_id' in tabela.c:
+        return tabela.c.escola_id % total == shard
+    if tabela is ItemPedido.__table__:
+        return tabela.c.pedido_id.in_(select(Pedido.id).where(Pedido.escola_id % total == shard))
+    return tabela.c.pedido_id.in_(select(PedidoArquivo.id).where(PedidoArquivo.escola_id % total == shard))
+
+def migrar_para_shards():
+    """Move para os shards os pedidos e o estoque gravados no banco principal antes de ligar o sharding.
+
+    Lote a lote: copia para o shard com upsert pela chave primária e, após o commit no shard, apaga do
+    principal só as linhas copiadas (pedidos junto com seus itens). Pode ser reexecutado após uma falha.
+    Linhas sem escola_id não têm shard e ficam no principal.
+    Retorna (linhas movidas, linhas sem shard).
+    """
+    total = len(shard_engines)
+    movidas = 0
+    alterados = set()
+    for modelo, filho in ((EstoqueEscola, None), (Pedido, ItemPedido), (PedidoArquivo, ItemPedidoArquivo)):
+        tabela = modelo.__table__
+        ultimo = 0
+        while True:
+            with engine.connect() as origem:
+                lote = origem.execute(
+                    select(tabela).where(tabela.c.escola_id.isnot(None), tabela.c.id > ultimo)
+                    .order_by(tabela.c.id).limit(BACKUP_LOTE)
+                ).mappings().all()
+                if not lote:
+                    break
+                ultimo = lote[-1]['id']
+                ids = [linha['id'] for linha in lote]
+                filhos = origem.execute(
+                    select(filho.__table__).where(filho.pedido_id.in_(ids))
+                ).mappings().all() if filho is not None else []
+
+            for shard in range(total):
+                linhas = [dict(linha) for linha in lote if linha['escola_id'] % total == shard]
+                if not linhas:
+                    continue
+                ids_shard = {linha['id'] for linha in linhas}
+                linhas_filhos = [dict(linha) for linha in filhos if linha['pedido_id'] in ids_shard]
+                with shard_engines[shard].begin() as destino:
+                    destino.execute(_upsert_pela_chave(destino.dialect.name, tabela), linhas)
+                    if linhas_filhos:
+                        destino.execute(_upsert_pela_chave(destino.dialect.name, filho.__table__), linhas_filhos)
+                with engine.begin() as conn:
+                    if filho is not None:
+                        conn.execute(filho.__table__.delete().where(filho.pedido_id.in_(ids_shard)))
+                    conn.execute(tabela.delete().where(tabela.c.id.in_(ids_shard)))
+                movidas += len(linhas) + len(linhas_filhos)
+                alterados.add(shard)
+
+    for shard in alterados:
+        with shard_engines[shard].begin() as destino:
+            ajustar_sequencias(destino, TABELAS_POR_ESCOLA)
+            destino.execute(update(VersaoDados).where(VersaoDados.familia == 'estoque')
+                            .values(versao=VersaoDados.versao + 1))
+        get_cache_dados(shard).invalidar()
+
+    with engine.connect() as conn:
+        sem_shard = sum(conn.execute(select(func.count()).select_from(modelo).where(modelo.escola_id.is_(None))).scalar()
+                        for modelo in (EstoqueEscola, Pedido, PedidoArquivo))
+    if movidas:
+        # os agregados do principal deixam de valer: passam a ser calculados em cada shard
+        with engine.begin() as conn:
+            conn.execute(ClienteAgregado.__table__.delete())
+        reconstruir_agregados_clientes()
+    return movidas, sem_shard
+
+@st.cache_resource
+def preparar_shards(urls):
+    """Uma vez por processo: sincroniza as tabelas replicadas e move para os shards os dados por escola
+    que ainda estejam no banco principal."""
+    if shard_engines:
+        sincronizar_shards()
+        movidas, sem_shard = migrar_para_shards()
+        if movidas:
+            registrar_auditoria('migrar_para_shards', None, None, {'linhas': movidas, 'shards': len(shard_engines)})
+        if sem_shard:
+            st.warning(f"{sem_shard} pedido(s)/item(ns) de estoque sem escola ficaram no banco principal e "
+                       "não aparecem com o sharding ativo.")
+    return True
+
 # Inicialização do banco apenas se SQLAlchemy estiver disponível
 if SQLALCHEMY_AVAILABLE:
     try:
-        engine = create_engine(get_database_url())
+        engine = criar_engine(get_database_url())
+        read_engine = criar_engine(get_read_database_url()) if get_read_database_url() else None
         Base = declarative_base()
 
         # Definir modelos
@@ -61,6 +327,7 @@ if SQLALCHEMY_AVAILABLE:
             cpf = Column(String(20))
             endereco = Column(Text)
             criado_em = Column(DateTime, default=datetime.now)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
 
         class Escola(Base):
             __tablename__ = 'escolas'
@@ -82,6 +349,7 @@ if SQLALCHEMY_AVAILABLE:
             estoque_minimo = Column(Integer, default=5)
             tamanho = Column(String(10))
             criado_em = Column(DateTime, default=datetime.now)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
             __table_args__ = (UniqueConstraint('nome', 'tamanho', name='_nome_tamanho_uc'),)
 
         class EstoqueEscola(Base):
@@ -90,12 +358,14 @@ if SQLALCHEMY_AVAILABLE:
             escola_id = Column(Integer, ForeignKey('escolas.id'))
             produto_id = Column(Integer, ForeignKey('produtos.id'))
             quantidade = Column(Integer, default=0)
+            versao = Column(Integer, default=0, nullable=False)  # incrementada a cada alteração (controle otimista)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
             __table_args__ = (UniqueConstraint('escola_id', 'produto_id', name='_escola_produto_uc'),)
 
         class Pedido(Base):
             __tablename__ = 'pedidos'
             id = Column(Integer, primary_key=True)
-            cliente_id = Column(Integer, ForeignKey('clientes.id'))
+            cliente_id = Column(Integer, ForeignKey('clientes.id'), index=True)
             escola_id = Column(Integer, ForeignKey('escolas.id'))
             status = Column(String(20), default='Pendente')
             total = Column(Float)
@@ -104,6 +374,9 @@ if SQLALCHEMY_AVAILABLE:
             lucro_total = Column(Float)
             margem_lucro = Column(Float)
             criado_em = Column(DateTime, default=datetime.now)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
+            chave_idempotencia = Column(String(64), unique=True, index=True)  # repetição do envio devolve o mesmo pedido
+            __table_args__ = (Index('ix_pedidos_status_criado_em', 'status', 'criado_em'),)
 
         class ItemPedido(Base):
             __tablename__ = 'itens_pedido'
@@ -115,15 +388,618 @@ if SQLALCHEMY_AVAILABLE:
             custo_unitario = Column(Float)
             lucro_unitario = Column(Float)
             margem_lucro = Column(Float)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
+
+        # Log de auditoria (somente inserção)
+        class Auditoria(Base):
+            __tablename__ = 'auditoria'
+            id = Column(Integer, primary_key=True)
+            usuario = Column(String(50))
+            acao = Column(String(50), nullable=False)
+            entidade = Column(String(50))
+            entidade_id = Column(Integer)
+            detalhes = Column(Text)
+            criado_em = Column(DateTime, default=datetime.now, index=True)
+            __table_args__ = (
+                Index('ix_auditoria_usuario_criado_em', 'usuario', 'criado_em'),
+                Index('ix_auditoria_entidade', 'entidade', 'entidade_id', 'criado_em'),
+            )
+
+        # Agregados de compras por cliente, mantidos por add_pedido/update_pedido_status
+        class ClienteAgregado(Base):
+            __tablename__ = 'clientes_agregados'
+            cliente_id = Column(Integer, ForeignKey('clientes.id'), primary_key=True)
+            total_pedidos = Column(Integer, default=0)
+            valor_total = Column(Float, default=0)
+            primeira_compra = Column(DateTime)
+            ultima_compra = Column(DateTime, index=True)
+            escolas = Column(Text, default=',')  # ids no formato ",1,4,"
+
+        # Arquivo de pedidos finalizados (mesmas colunas das tabelas quentes + arquivado_em)
+        class PedidoArquivo(Base):
+            __tablename__ = 'pedidos_arquivo'
+            id = Column(Integer, primary_key=True, autoincrement=False)
+            cliente_id = Column(Integer, ForeignKey('clientes.id'))
+            escola_id = Column(Integer, ForeignKey('escolas.id'), index=True)
+            status = Column(String(20))
+            total = Column(Float)
+            desconto = Column(Float)
+            custo_total = Column(Float)
+            lucro_total = Column(Float)
+            margem_lucro = Column(Float)
+            criado_em = Column(DateTime, index=True)
+            atualizado_em = Column(DateTime)
+            chave_idempotencia = Column(String(64))
+            arquivado_em = Column(DateTime, default=datetime.now)
+
+        class ItemPedidoArquivo(Base):
+            __tablename__ = 'itens_pedido_arquivo'
+            id = Column(Integer, primary_key=True, autoincrement=False)
+            pedido_id = Column(Integer, ForeignKey('pedidos_arquivo.id'), index=True)
+            produto_id = Column(Integer, ForeignKey('produtos.id'))
+            quantidade = Column(Integer)
+            preco_unitario = Column(Float)
+            custo_unitario = Column(Float)
+            lucro_unitario = Column(Float)
+            margem_lucro = Column(Float)
+            atualizado_em = Column(DateTime)
+            arquivado_em = Column(DateTime, default=datetime.now)
+
+        # Rastreamento de alterações: exclusões (tombstones) e cursor de exportação por consumidor
+        class RegistroExcluido(Base):
+            __tablename__ = 'registros_excluidos'
+            id = Column(Integer, primary_key=True)
+            tabela = Column(String(50), nullable=False)
+            registro_id = Column(Integer, nullable=False)
+            excluido_em = Column(DateTime, default=datetime.now, index=True)
+
+        class CursorExportacao(Base):
+            __tablename__ = 'cursores_exportacao'
+            id = Column(Integer, primary_key=True)
+            consumidor = Column(String(50), nullable=False)
+            tabela = Column(String(50), nullable=False)
+            watermark = Column(DateTime)
+            atualizado_em = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+            __table_args__ = (UniqueConstraint('consumidor', 'tabela', name='_consumidor_tabela_uc'),)
+
+        # Replicações para os shards que falharam após o commit no principal (refeitas por sincronizar_shards)
+        class ReplicacaoPendente(Base):
+            __tablename__ = 'replicacoes_pendentes'
+            id = Column(Integer, primary_key=True)
+            tarefa = Column(Text, nullable=False)
+            erro = Column(Text)
+            criado_em = Column(DateTime, default=datetime.now)
+
+        class VersaoDados(Base):
+            __tablename__ = 'versoes_dados'
+            id = Column(Integer, primary_key=True)
+            familia = Column(String(30), unique=True, nullable=False)
+            versao = Column(Integer, default=0, nullable=False)
+
+        TABELAS_RASTREADAS = {
+            'pedidos': Pedido,
+            'itens_pedido': ItemPedido,
+            'clientes': Cliente,
+            'produtos': Produto,
+            'estoque_escolas': EstoqueEscola,
+        }
+
+        # Com sharding, estas tabelas ficam no shard da escola; as demais, no banco principal
+        TABELAS_POR_ESCOLA = [modelo.__table__ for modelo in
+                              (EstoqueEscola, Pedido, ItemPedido, ClienteAgregado, PedidoArquivo, ItemPedidoArquivo)]
+
+        def registrar_exclusoes(conexao, tabela, registro_ids):
+            registro_ids = list(registro_ids)
+            if tabela in TABELAS_RASTREADAS and registro_ids:
+                agora = datetime.now()
+                conexao.execute(RegistroExcluido.__table__.insert(), [
+                    {'tabela': tabela, 'registro_id': registro_id, 'excluido_em': agora}
+                    for registro_id in registro_ids
+                ])
+
+        def _registrar_exclusao_orm(mapper, connection, target):
+            registrar_exclusoes(connection, mapper.local_table.name, [target.id])
+
+        for _modelo in TABELAS_RASTREADAS.values():
+            event.listen(_modelo, 'after_delete', _registrar_exclusao_orm)
+
+        # Atualização automática da estrutura: cria colunas e índices que faltam em bancos existentes
+        def atualizar_estrutura_banco(motor=None):
+            motor = motor or engine
+            inspetor = inspect(motor)
+            with motor.begin() as conn:
+                for tabela in Base.metadata.sorted_tables:
+                    existentes = {c['name'] for c in inspetor.get_columns(tabela.name)}
+                    for coluna in tabela.columns:
+                        if coluna.name in existentes:
+                            continue
+                        tipo = coluna.type.compile(dialect=motor.dialect)
+                        conn.execute(text(f'ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {tipo}'))
+                        if coluna.default is not None:
+                            valor = coluna.default.arg(None) if coluna.default.is_callable else coluna.default.arg
+                            if coluna.name == 'atualizado_em' and 'criado_em' in existentes:
+                                conn.execute(text(f'UPDATE {tabela.name} SET {coluna.name} = COALESCE(criado_em, :valor)'),
+                                             {'valor': valor})
+                            else:
+                                conn.execute(text(f'UPDATE {tabela.name} SET {coluna.name} = :valor'), {'valor': valor})
+                    for indice in tabela.indexes:
+                        indice.create(conn, checkfirst=True)
+
+        # Agregados de clientes recalculados a partir dos pedidos (sem commit; serve a Session ou Connection)
+        def recalcular_agregados(conn, cliente_ids=None):
+            todos = union_all(*[
+                select(modelo.cliente_id, modelo.escola_id, modelo.total, modelo.criado_em)
+                .where(modelo.status != 'Cancelado')
+                for modelo in (Pedido, PedidoArquivo)
+            ]).subquery()
+            filtro = [todos.c.cliente_id.in_(list(cliente_ids))] if cliente_ids is not None else []
+
+            resumo = conn.execute(
+                select(todos.c.cliente_id, func.count(), func.sum(todos.c.total),
+                       func.min(todos.c.criado_em), func.max(todos.c.criado_em))
+                .where(*filtro).group_by(todos.c.cliente_id)
+            ).all()
+            escolas = {}
+            for cliente_id, escola_id in conn.execute(
+                select(todos.c.cliente_id, todos.c.escola_id).where(*filtro).distinct()
+            ):
+                escolas.setdefault(cliente_id, []).append(str(escola_id))
+
+            exclusao = ClienteAgregado.__table__.delete()
+            if cliente_ids is not None:
+                exclusao = exclusao.where(ClienteAgregado.cliente_id.in_(list(cliente_ids)))
+            conn.execute(exclusao)
+            if resumo:
+                conn.execute(insert(ClienteAgregado), [{
+                    'cliente_id': cliente_id,
+                    'total_pedidos': quantidade,
+                    'valor_total': valor or 0,
+                    'primeira_compra': primeira,
+                    'ultima_compra': ultima,
+                    'escolas': ',' + ','.join(sorted(escolas.get(cliente_id, []), key=int)) + ',',
+                } for cliente_id, quantidade, valor, primeira, ultima in resumo])
+
+        # Criar tabelas e atualizar a estrutura uma vez por processo
+        @st.cache_resource
+        def preparar_banco(database_url):
+            motor = criar_engine(database_url)
+            agregados_existiam = inspect(motor).has_table(ClienteAgregado.__tablename__)
+            Base.metadata.create_all(motor)
+            atualizar_estrutura_banco(motor)
+            with motor.begin() as conn:
+                _garantir_versoes(conn)
+                # Bancos anteriores aos agregados: preenche a partir do histórico de pedidos
+                if not agregados_existiam or conn.execute(select(ClienteAgregado.cliente_id).limit(1)).first() is None:
+                    recalcular_agregados(conn)
+            return True
+
+        preparar_banco(get_database_url())
+        shard_engines = [criar_engine(url) for url in get_shard_database_urls()]
+        for _url in get_shard_database_urls():
+            preparar_banco(_url)
 
-        # Criar tabelas
-        Base.metadata.create_all(engine)
         Session = sessionmaker(bind=engine)
+        sessoes_shard = [sessionmaker(bind=motor, info={'shard': i}) for i, motor in enumerate(shard_engines)]
+        for _fabrica in [Session] + sessoes_shard:
+            event.listen(_fabrica, 'after_commit', _apos_commit)
+            event.listen(_fabrica, 'after_rollback', _apos_rollback)
         
     except Exception as e:
         st.error(f"Erro ao inicializar SQLAlchemy: {e}")
         SQLALCHEMY_AVAILABLE = False
 
+# Roteamento de leituras: réplica (READ_DATABASE_URL) com fallback para o primário
+REPLICA_STICKY_SEGUNDOS = 5     # após um commit, a sessão do usuário lê do primário (read your writes)
+REPLICA_PAUSA_FALHA = 30        # após uma falha, a réplica fica fora por este tempo
+REPLICA_ATRASO_MAXIMO = 10      # atraso de replicação tolerado pelas exportações incrementais
+TRANSACAO_DURACAO_MAXIMA = 30   # atualizado_em é gravado no flush: transações abertas há até este tempo ainda são exportadas
+
+@st.cache_resource
+def _estado_replica():
+    return {'falhou_em': 0.0}
+
+def marcar_escrita():
+    try:
+        st.session_state['_ler_primario_ate'] = time.time() + REPLICA_STICKY_SEGUNDOS
+    except Exception:
+        pass  # fora de uma execução do Streamlit (threads de fundo)
+
+def _usar_replica():
+    if read_engine is None:
+        return False
+    try:
+        if time.time() < st.session_state.get('_ler_primario_ate', 0):
+            return False
+    except Exception:
+        pass
+    return time.time() - _estado_replica()['falhou_em'] >= REPLICA_PAUSA_FALHA
+
+@contextmanager
+def conexao_leitura(primario=False, isolada=False):
+    """Conexão para consultas somente-leitura, roteada para a réplica quando possível.
+
+    Dentro de uma unidade de trabalho, reutiliza a conexão dela, exceto com `primario` ou `isolada`.
+    """
+    unidade = unidade_atual()
+    if unidade is not None and not primario and not isolada:
+        yield unidade.obter_leitura()
+        return
+    conn = None
+    if not primario and _usar_replica():
+        try:
+            conn = read_engine.connect()
+        except OperationalError:
+            _estado_replica()['falhou_em'] = time.time()
+    if conn is None:
+        conn = engine.connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def corte_incremental(conn, ate):
+    """Recua o corte de exportações/backups incrementais para não perder linhas ainda não visíveis em `conn`:
+    transações em andamento (carimbadas antes do commit) e, na réplica, commits ainda não replicados."""
+    atraso = TRANSACAO_DURACAO_MAXIMA + (REPLICA_ATRASO_MAXIMO if lendo_da_replica(conn) else 0)
+    return ate - timedelta(seconds=atraso)
+
+def lendo_da_replica(conn):
+    return read_engine is not None and conn.engine is read_engine
+
+# Leituras somente-consulta: Core select() nas colunas necessárias, sem Session/identity map
+def executar_leitura(stmt, primario=False, shard=None):
+    if shard is not None:
+        with shard_engines[shard].connect() as conn:
+            return conn.execute(stmt).all()
+    with conexao_leitura(primario) as conn:
+        return conn.execute(stmt).all()
+
+def ler_todas_escolas(stmt):
+    """Consulta de dados por escola: com sharding, roda em todos os shards em paralelo e concatena as linhas."""
+    if not shard_engines:
+        return executar_leitura(stmt)
+    linhas = []
+    for parte in get_pool_shards().map(lambda shard: executar_leitura(stmt, shard=shard), range(len(shard_engines))):
+        linhas.extend(parte)
+    return linhas
+
+# Unidade de trabalho por rerun: uma sessão de escrita e uma conexão de leitura compartilhadas
+_contexto = threading.local()
+
+class UnidadeDeTrabalho:
+    def __init__(self):
+        self.sessao = None
+        self.leitura = None
+        self.em_lote = 0
+        self.desfeito = False
+
+    def obter_sessao(self):
+        if self.sessao is None:
+            self.sessao = Session()
+        return self.sessao
+
+    def obter_leitura(self):
+        if self.leitura is None:
+            conn = None
+            if _usar_replica():
+                try:
+                    conn = read_engine.connect()
+                except OperationalError:
+                    _estado_replica()['falhou_em'] = time.time()
+            if conn is None:
+                conn = engine.connect()
+            if conn.dialect.name == 'postgresql':
+                # Foto consistente para todas as leituras do rerun
+                conn = conn.execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True)
+            conn.begin()
+            self.leitura = conn
+        return self.leitura
+
+    def invalidar_leitura(self):
+        if self.leitura is not None:
+            self.leitura.close()
+            self.leitura = None
+
+    def fechar(self):
+        self.invalidar_leitura()
+        if self.sessao is not None:
+            self.sessao.close()
+            self.sessao = None
+
+def unidade_atual():
+    return getattr(_contexto, 'unidade', None)
+
+@contextmanager
+def unidade_de_trabalho():
+    """Abre a unidade de trabalho do rerun; as funções de dados a reutilizam enquanto ela estiver ativa."""
+    if unidade_atual() is not None:
+        yield unidade_atual()
+        return
+    unidade = UnidadeDeTrabalho()
+    _contexto.unidade = unidade
+    try:
+        yield unidade
+    finally:
+        _contexto.unidade = None
+        unidade.fechar()
+
+class LoteDesfeito(Exception):
+    """Uma das escritas de transacao() falhou e nada do bloco foi gravado."""
+
+@contextmanager
+def transacao():
+    """Agrupa várias escritas da unidade de trabalho em um único commit ao final do bloco.
+
+    Se uma delas falhar, o bloco inteiro é desfeito e LoteDesfeito é levantada na saída.
+    """
+    unidade = unidade_atual()
+    if unidade is None:
+        yield
+        return
+    unidade.em_lote += 1
+    try:
+        yield
+    except Exception:
+        unidade.em_lote -= 1
+        unidade.desfeito = False
+        unidade.obter_sessao().rollback()
+        raise
+    unidade.em_lote -= 1
+    if unidade.em_lote == 0:
+        if unidade.desfeito:
+            unidade.desfeito = False
+            unidade.obter_sessao().rollback()
+            raise LoteDesfeito("Uma das alterações falhou; nenhuma alteração do bloco foi gravada")
+        unidade.obter_sessao().commit()
+        unidade.invalidar_leitura()
+
+def abrir_sessao(shard=None):
+    """Sessão de escrita; `shard` (de shard_da_escola) abre uma sessão própria no banco da escola."""
+    if shard is not None:
+        return sessoes_shard[shard]()
+    unidade = unidade_atual()
+    return unidade.obter_sessao() if unidade is not None else Session()
+
+def confirmar(session):
+    unidade = unidade_atual()
+    if unidade is not None and session is unidade.sessao:
+        if unidade.em_lote:
+            session.flush()
+            return
+        session.commit()
+        unidade.invalidar_leitura()
+    else:
+        session.commit()
+
+def desfazer(session):
+    """Desfaz a escrita que falhou. Dentro de transacao() isso desfaz também as anteriores do bloco,
+    que então é marcado para terminar com LoteDesfeito em vez de gravar só parte das alterações."""
+    session.rollback()
+    unidade = unidade_atual()
+    if unidade is not None and session is unidade.sessao and unidade.em_lote:
+        unidade.desfeito = True
+
+def fechar_sessao(session):
+    unidade = unidade_atual()
+    if unidade is None or session is not unidade.sessao:
+        session.close()
+
+class CacheDados:
+    """Cache por processo das listas de referência, válido enquanto as versões das famílias não mudarem.
+    
+    As versões são relidas no máximo a cada VERSOES_INTERVALO segundos, logo após um commit desta
+    instância ou quando chega um NOTIFY do PostgreSQL. Versões e valores são guardados por origem da
+    leitura (réplica ou primário), para um valor atrasado da réplica nunca ficar sob a versão do primário.
+    """
+    def __init__(self, database_url, shard=None):
+        self._lock = threading.Lock()
+        self._versoes = {}
+        self._verificado_em = {}
+        self._geracao = 0
+        self._itens = {}
+        self._escutando = False
+        self._shard = shard
+        motor = engine if shard is None else shard_engines[shard]
+        if motor.dialect.name == 'postgresql' and motor.dialect.driver == 'psycopg2':
+            threading.Thread(target=self._escutar, args=(database_url,), daemon=True).start()
+
+    def invalidar(self):
+        with self._lock:
+            self._geracao += 1
+            self._verificado_em.clear()
+
+    def _origem(self):
+        """De onde `carregar` vai ler agora, com o mesmo roteamento de conexao_leitura."""
+        if self._shard is not None:
+            return 'primario'
+        unidade = unidade_atual()
+        if unidade is not None and unidade.leitura is not None:
+            return 'replica' if lendo_da_replica(unidade.leitura) else 'primario'
+        return 'replica' if _usar_replica() else 'primario'
+
+    def _versoes_atuais(self, origem):
+        # O NOTIFY chega pelo primário; a réplica continua sendo conferida a cada VERSOES_INTERVALO
+        intervalo = VERSOES_INTERVALO_NOTIFY if self._escutando and origem == 'primario' else VERSOES_INTERVALO
+        with self._lock:
+            if time.monotonic() - self._verificado_em.get(origem, 0.0) < intervalo:
+                return self._versoes[origem]
+            geracao = self._geracao
+        versoes = dict(executar_leitura(select(VersaoDados.familia, VersaoDados.versao), shard=self._shard))
+        with self._lock:
+            if geracao == self._geracao:  # não houve invalidação durante a leitura
+                self._versoes[origem] = versoes
+                self._verificado_em[origem] = time.monotonic()
+        return versoes
+
+    def obter(self, familias, chave, carregar):
+        """Devolve o valor em cache para (familias, chave) ou chama `carregar` se alguma versão mudou."""
+        origem = self._origem()
+        try:
+            versoes = self._versoes_atuais(origem)
+        except Exception:
+            return carregar()
+        versao = tuple(versoes.get(familia) for familia in familias)
+        if None in versao:
+            return carregar()
+        with self._lock:
+            item = self._itens.get((origem, familias, chave))
+        if item is not None and item[0] == versao:
+            return item[1]
+        valor = carregar()
+        with self._lock:
+            self._itens[(origem, familias, chave)] = (versao, valor)
+        return valor
+
+    def _escutar(self, database_url):
+        motor = create_engine(database_url, poolclass=NullPool)
+        while True:
+            try:
+                bruta = motor.raw_connection()
+                try:
+                    conexao = bruta.driver_connection
+                    conexao.autocommit = True
+                    with conexao.cursor() as cursor:
+                        cursor.execute(f'LISTEN {CANAL_VERSOES}')
+                    self._escutando = True
+                    self.invalidar()  # avisos perdidos enquanto desconectado
+                    seletor = selectors.DefaultSelector()
+                    seletor.register(conexao, selectors.EVENT_READ)
+                    while True:
+                        if seletor.select(timeout=VERSOES_INTERVALO_NOTIFY):
+                            conexao.poll()
+                            if conexao.notifies:
+                                conexao.notifies.clear()
+                                self.invalidar()
+                finally:
+                    self._escutando = False
+                    bruta.close()
+            except Exception:
+                time.sleep(5)
+
+@st.cache_resource
+def _criar_cache_dados(shard):
+    if shard is None:
+        return CacheDados(get_database_url())
+    return CacheDados(get_shard_database_urls()[shard], shard)
+
+def get_cache_dados(shard=None):
+    """Cache do banco principal ou, para estoque com sharding, o do shard informado."""
+    return _criar_cache_dados(shard)
+
+# Auditoria: fila em memória gravada em lotes por uma thread de fundo
+AUDITORIA_LOTE = 200
+AUDITORIA_INTERVALO = 1.0   # segundos máximos entre gravações
+
+class GravadorAuditoria:
+    def __init__(self, database_url, tabela):
+        self.engine = create_engine(database_url)
+        self.tabela = tabela
+        self.fila = queue.Queue()
+        self.trava = threading.Lock()
+        self.thread = threading.Thread(target=self._executar, name='gravador-auditoria', daemon=True)
+        self.thread.start()
+        atexit.register(self.descarregar)
+
+    def registrar(self, entrada):
+        self.fila.put(entrada)
+
+    def _coletar_lote(self, bloquear):
+        lote = []
+        limite = time.time() + AUDITORIA_INTERVALO
+        while len(lote) < AUDITORIA_LOTE:
+            try:
+                espera = max(limite - time.time(), 0) if bloquear else 0
+                lote.append(self.fila.get(timeout=espera) if bloquear else self.fila.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _gravar(self, lote):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.tabela.insert(), lote)
+            return True
+        except Exception:
+            # Banco indisponível: devolve as entradas à fila para a próxima tentativa
+            for entrada in lote:
+                self.fila.put(entrada)
+            return False
+        finally:
+            for _ in lote:
+                self.fila.task_done()
+
+    def _executar(self):
+        while True:
+            primeira = self.fila.get()
+            # O lote é montado e gravado sob a trava, para descarregar() esperar o lote em andamento
+            with self.trava:
+                gravado = self._gravar([primeira] + self._coletar_lote(bloquear=True))
+            if not gravado:
+                time.sleep(AUDITORIA_INTERVALO)
+
+    def descarregar(self):
+        """Grava imediatamente tudo o que estiver na fila (consultas do painel e encerramento)."""
+        with self.trava:
+            lote = self._coletar_lote(bloquear=False)
+            while lote and self._gravar(lote):
+                lote = self._coletar_lote(bloquear=False)
+        if not lote:
+            # A thread pode ter retirado uma entrada da fila antes de pegar a trava: espera ela ser gravada
+            with self.fila.all_tasks_done:
+                self.fila.all_tasks_done.wait_for(lambda: not self.fila.unfinished_tasks,
+                                                  timeout=AUDITORIA_INTERVALO * 5)
+
+@st.cache_resource
+def get_gravador_auditoria():
+    return GravadorAuditoria(get_database_url(), Auditoria.__table__)
+
+def registrar_auditoria(acao, entidade=None, entidade_id=None, detalhes=None, usuario=None, session=None):
+    """Enfileira uma entrada de auditoria. Com a `session` da escrita dentro de transacao(), a entrada
+    só segue no commit do bloco e é descartada se ele for desfeito."""
+    if not SQLALCHEMY_AVAILABLE:
+        return
+    if usuario is None:
+        try:
+            usuario = st.session_state.user[1] if st.session_state.get('user') else None
+        except Exception:
+            usuario = None
+    entrada = {
+        'usuario': usuario or 'sistema',
+        'acao': acao,
+        'entidade': entidade,
+        'entidade_id': entidade_id,
+        'detalhes': json.dumps(detalhes, default=str, ensure_ascii=False) if detalhes is not None else None,
+        'criado_em': datetime.now(),
+    }
+    unidade = unidade_atual()
+    if session is not None and unidade is not None and session is unidade.sessao and unidade.em_lote:
+        session.info.setdefault('auditoria_pendente', []).append(entrada)
+        return
+    get_gravador_auditoria().registrar(entrada)
+
+def get_auditoria(usuario=None, entidade=None, entidade_id=None, inicio=None, fim=None, limite=500):
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+
+    get_gravador_auditoria().descarregar()
+    stmt = select(Auditoria.criado_em, Auditoria.usuario, Auditoria.acao, Auditoria.entidade,
+                  Auditoria.entidade_id, Auditoria.detalhes)
+    if usuario:
+        stmt = stmt.where(Auditoria.usuario == usuario)
+    if entidade:
+        stmt = stmt.where(Auditoria.entidade == entidade)
+    if entidade_id:
+        stmt = stmt.where(Auditoria.entidade_id == entidade_id)
+    if inicio:
+        stmt = stmt.where(Auditoria.criado_em >= inicio)
+    if fim:
+        stmt = stmt.where(Auditoria.criado_em < fim)
+    try:
+        return executar_leitura(stmt.order_by(Auditoria.criado_em.desc()).limit(limite), primario=True)
+    except Exception as e:
+        st.error(f"Erro ao buscar auditoria: {e}")
+        return []
+
 # Função para obter data/hora do Brasil
 def get_brasil_datetime():
     tz_brasil = pytz.timezone('America/Sao_Paulo')
@@ -143,20 +1019,22 @@ def init_db():
         st.error("SQLAlchemy não está disponível. Verifique as dependências.")
         return
         
-    session = Session()
+    session = abrir_sessao()
     try:
+        preparar_shards(tuple(get_shard_database_urls()))
+        get_fila_pedidos()  # inicia o envio de pedidos que ficaram pendentes na fila local
         # Verificar se usuário admin existe
         admin = session.query(Usuario).filter_by(username='admin').first()
         if not admin:
             senha_hash = hashlib.sha256("admin123".encode()).hexdigest()
             admin = Usuario(username='admin', password=senha_hash, nivel='admin')
             session.add(admin)
-            session.commit()
+            confirmar(session)
     except Exception as e:
         st.error(f"Erro ao inicializar banco: {e}")
-        session.rollback()
+        desfazer(session)
     finally:
-        session.close()
+        fechar_sessao(session)
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -166,7 +1044,7 @@ def verify_login(username, password):
         st.error("Sistema de banco de dados não disponível")
         return None
         
-    session = Session()
+    session = abrir_sessao()
     try:
         user = session.query(Usuario).filter_by(username=username).first()
         if user and user.password == hash_password(password):
@@ -176,7 +1054,7 @@ def verify_login(username, password):
         st.error(f"Erro ao verificar login: {e}")
         return None
     finally:
-        session.close()
+        fechar_sessao(session)
 
 # Funções de Gestão de Clientes
 def add_cliente(nome, telefone, email, cpf, endereco):
@@ -184,7 +1062,7 @@ def add_cliente(nome, telefone, email, cpf, endereco):
         st.error("Sistema de banco de dados não disponível")
         return False
         
-    session = Session()
+    session = abrir_sessao()
     try:
         cliente = Cliente(
             nome=nome,
@@ -194,28 +1072,211 @@ def add_cliente(nome, telefone, email, cpf, endereco):
             endereco=endereco
         )
         session.add(cliente)
-        session.commit()
+        session.flush()
+        cliente_id = cliente.id
+        incrementar_versoes(session, 'clientes')
+        agendar_replicacao(session, 'clientes', [cliente_id])
+        confirmar(session)
+        registrar_auditoria('criar', 'clientes', cliente_id, {'nome': nome}, session=session)
         return True
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao cadastrar cliente: {e}")
         return False
     finally:
-        session.close()
+        fechar_sessao(session)
 
 def get_clientes():
     if not SQLALCHEMY_AVAILABLE:
         return []
         
-    session = Session()
     try:
-        clientes = session.query(Cliente).order_by(Cliente.nome).all()
-        return [(c.id, c.nome, c.telefone, c.email, c.cpf, c.endereco, c.criado_em) for c in clientes]
+        return get_cache_dados().obter(('clientes',), None, lambda: executar_leitura(
+            select(Cliente.id, Cliente.nome, Cliente.telefone, Cliente.email,
+                   Cliente.cpf, Cliente.endereco, Cliente.criado_em)
+            .order_by(Cliente.nome)
+        ))
+    except Exception as e:
+        st.error(f"Erro ao buscar clientes: {e}")
+        return []
+
+# Detecção e mesclagem de clientes duplicados
+DUPLICADOS_LIMIAR = 0.8
+DUPLICADOS_MAX_BLOCO = 50   # blocos maiores (nomes comuns, telefone genérico) são subdivididos
+DUPLICADOS_JANELA = 20      # sem como subdividir, cada cliente é comparado só com os vizinhos na ordem do nome
+
+def _normalizar_texto(texto):
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', re.sub(r'[^a-z0-9 ]', ' ', texto.lower())).strip()
+
+def _normalizar_cpf(cpf):
+    digitos = re.sub(r'\D', '', cpf or '')
+    return digitos if len(digitos) == 11 and len(set(digitos)) > 1 else None  # 000.000.000-00 e afins são marcadores
+
+def _normalizar_telefone(telefone):
+    digitos = re.sub(r'\D', '', telefone or '')
+    return digitos[-8:] if len(digitos) >= 8 else None
+
+_REGRAS_FONETICAS = [
+    (r'ph', 'f'), (r'th', 't'), (r'sh|ch', 'x'), (r'lh', 'l'), (r'nh', 'n'),
+    (r'qu|q', 'k'), (r'c(?=[ei])', 's'), (r'c', 'k'), (r'g(?=[ei])', 'j'), (r'y', 'i'),
+    (r'w', 'v'), (r'z', 's'), (r'h', ''), (r'(.)\1+', r'\1'),
+]
+
+def _chave_fonetica(nome):
+    """Chave fonética simplificada para português: primeiro e último nome sem vogais internas."""
+    partes = [p for p in _normalizar_texto(nome).split() if len(p) > 2]
+    if not partes:
+        return None
+    chaves = []
+    for parte in (partes[0], partes[-1]) if len(partes) > 1 else (partes[0],):
+        for padrao, troca in _REGRAS_FONETICAS:
+            parte = re.sub(padrao, troca, parte)
+        chaves.append(parte[:1] + re.sub(r'[aeiou]', '', parte[1:]))
+    return ' '.join(chaves)
+
+def _pontuar_par(a, b):
+    if a['cpf'] and b['cpf']:
+        return 1.0 if a['cpf'] == b['cpf'] else 0.0
+    pontuacao = 0.6 * SequenceMatcher(None, a['nome'], b['nome']).ratio()
+    if a['telefone'] and a['telefone'] == b['telefone']:
+        pontuacao += 0.25
+    if a['email'] and a['email'] == b['email']:
+        pontuacao += 0.15
+    if a['fonetica'] and a['fonetica'] == b['fonetica']:
+        pontuacao += 0.15
+    return min(pontuacao, 1.0)
+
+_SUBCHAVES_DUPLICADOS = [
+    lambda cliente: cliente['nome'][:1],
+    lambda cliente: cliente['fonetica'],
+    lambda cliente: cliente['nome'].split(' ')[0],
+]
+
+def _sub_blocos(ids, clientes, nivel=0):
+    """Quebra blocos maiores que DUPLICADOS_MAX_BLOCO por chaves cada vez mais finas (inicial, fonética,
+    primeiro nome). Devolve (ids, janela); com janela, o bloco vem ordenado e só vizinhos são comparados."""
+    if len(ids) <= DUPLICADOS_MAX_BLOCO:
+        yield ids, False
+        return
+    if nivel == len(_SUBCHAVES_DUPLICADOS):
+        yield sorted(ids, key=lambda i: (clientes[i]['nome'], clientes[i]['email'] or '',
+                                         clientes[i]['telefone'] or '')), True
+        return
+    partes = {}
+    for cliente_id in ids:
+        partes.setdefault(_SUBCHAVES_DUPLICADOS[nivel](clientes[cliente_id]), []).append(cliente_id)
+    for parte in partes.values():
+        if len(parte) > 1:
+            yield from _sub_blocos(parte, clientes, nivel + 1)
+
+def encontrar_clientes_duplicados(limiar=DUPLICADOS_LIMIAR):
+    """Agrupa candidatos por CPF, telefone e chave fonética e só compara pares dentro de cada bloco;
+    blocos grandes são subdivididos (_sub_blocos), então o custo não cresce com o quadrado do bloco.
+
+    Retorna uma lista de grupos [{'ids': [...], 'pontuacao': float}], do mais provável ao menos provável.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+
+    try:
+        linhas = executar_leitura(select(Cliente.id, Cliente.nome, Cliente.telefone, Cliente.email, Cliente.cpf))
     except Exception as e:
         st.error(f"Erro ao buscar clientes: {e}")
         return []
+
+    clientes = {}
+    blocos = {}
+    for cliente_id, nome, telefone, email, cpf in linhas:
+        cliente = {
+            'nome': _normalizar_texto(nome),
+            'telefone': _normalizar_telefone(telefone),
+            'email': (email or '').strip().lower() or None,
+            'cpf': _normalizar_cpf(cpf),
+            'fonetica': _chave_fonetica(nome),
+        }
+        clientes[cliente_id] = cliente
+        for chave in ('cpf', 'telefone', 'fonetica'):
+            if cliente[chave]:
+                blocos.setdefault((chave, cliente[chave]), []).append(cliente_id)
+
+    pai = {}
+    def raiz(x):
+        while pai.get(x, x) != x:
+            pai[x] = pai.get(pai[x], pai[x])
+            x = pai[x]
+        return x
+
+    melhor = {}
+    comparados = set()
+    for ids in blocos.values():
+        if len(ids) < 2:
+            continue
+        for bloco, janela in _sub_blocos(ids, clientes):
+            for i, a in enumerate(bloco):
+                for b in bloco[i + 1:i + 1 + DUPLICADOS_JANELA] if janela else bloco[i + 1:]:
+                    par = (a, b) if a < b else (b, a)
+                    if par in comparados:
+                        continue
+                    comparados.add(par)
+                    pontuacao = _pontuar_par(clientes[a], clientes[b])
+                    if pontuacao >= limiar:
+                        ra, rb = raiz(a), raiz(b)
+                        if ra != rb:
+                            pai[max(ra, rb)] = min(ra, rb)
+                        melhor[par] = pontuacao
+
+    grupos = {}
+    for (a, b), pontuacao in melhor.items():
+        grupo = grupos.setdefault(raiz(a), {'ids': set(), 'pontuacao': 0.0})
+        grupo['ids'].update((a, b))
+        grupo['pontuacao'] = max(grupo['pontuacao'], pontuacao)
+
+    return sorted(({'ids': sorted(g['ids']), 'pontuacao': g['pontuacao']} for g in grupos.values()),
+                  key=lambda g: -g['pontuacao'])
+
+def mesclar_clientes(principal_id, duplicados_ids):
+    """Reaponta pedidos dos duplicados para o principal em lote, completa dados e remove os duplicados."""
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return False
+
+    duplicados_ids = [d for d in duplicados_ids if d != principal_id]
+    if not duplicados_ids:
+        return True
+
+    session = abrir_sessao()
+    try:
+        for modelo in (Pedido, PedidoArquivo):
+            session.execute(
+                update(modelo).where(modelo.cliente_id.in_(duplicados_ids)).values(cliente_id=principal_id)
+            )
+
+        principal = session.get(Cliente, principal_id)
+        for duplicado in session.query(Cliente).filter(Cliente.id.in_(duplicados_ids)).order_by(Cliente.id):
+            for campo in ('telefone', 'email', 'cpf', 'endereco'):
+                if not getattr(principal, campo) and getattr(duplicado, campo):
+                    setattr(principal, campo, getattr(duplicado, campo))
+        session.flush()
+
+        session.execute(ClienteAgregado.__table__.delete().where(ClienteAgregado.cliente_id.in_(duplicados_ids)))
+        session.execute(Cliente.__table__.delete().where(Cliente.id.in_(duplicados_ids)))
+        registrar_exclusoes(session.connection(), 'clientes', duplicados_ids)
+        incrementar_versoes(session, 'clientes')
+        agendar_replicacao(session, 'clientes', [principal_id])
+        if shard_engines:
+            session.info['replicar_shards'].setdefault('mesclar', []).append((principal_id, duplicados_ids))
+        confirmar(session)
+        registrar_auditoria('mesclar', 'clientes', principal_id, {'duplicados': duplicados_ids}, session=session)
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao mesclar clientes: {e}")
+        return False
     finally:
-        session.close()
+        fechar_sessao(session)
+
+    return reconstruir_agregados_clientes([principal_id])
 
 # Funções de Gestão de Escolas
 def add_escola(nome, telefone, email, endereco, responsavel):
@@ -223,7 +1284,7 @@ def add_escola(nome, telefone, email, endereco, responsavel):
         st.error("Sistema de banco de dados não disponível")
         return False
         
-    session = Session()
+    session = abrir_sessao()
     try:
         escola = Escola(
             nome=nome,
@@ -233,28 +1294,33 @@ def add_escola(nome, telefone, email, endereco, responsavel):
             responsavel=responsavel
         )
         session.add(escola)
-        session.commit()
+        session.flush()
+        escola_id = escola.id
+        incrementar_versoes(session, 'escolas')
+        agendar_replicacao(session, 'escolas', [escola_id])
+        confirmar(session)
+        registrar_auditoria('criar', 'escolas', escola_id, {'nome': nome}, session=session)
         return True
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao cadastrar escola: {e}")
         return False
     finally:
-        session.close()
+        fechar_sessao(session)
 
 def get_escolas():
     if not SQLALCHEMY_AVAILABLE:
         return []
         
-    session = Session()
     try:
-        escolas = session.query(Escola).order_by(Escola.nome).all()
-        return [(e.id, e.nome, e.telefone, e.email, e.endereco, e.responsavel, e.criado_em) for e in escolas]
+        return get_cache_dados().obter(('escolas',), None, lambda: executar_leitura(
+            select(Escola.id, Escola.nome, Escola.telefone, Escola.email,
+                   Escola.endereco, Escola.responsavel, Escola.criado_em)
+            .order_by(Escola.nome)
+        ))
     except Exception as e:
         st.error(f"Erro ao buscar escolas: {e}")
         return []
-    finally:
-        session.close()
 
 # Funções de Gestão de Produtos
 def add_produto(nome, descricao, preco, custo, estoque_minimo, tamanho):
@@ -262,7 +1328,7 @@ def add_produto(nome, descricao, preco, custo, estoque_minimo, tamanho):
         st.error("Sistema de banco de dados não disponível")
         return False, "Sistema indisponível"
         
-    session = Session()
+    session = abrir_sessao()
     try:
         # Verificar se produto já existe
         existente = session.query(Produto).filter_by(nome=nome, tamanho=tamanho).first()
@@ -278,106 +1344,224 @@ def add_produto(nome, descricao, preco, custo, estoque_minimo, tamanho):
             tamanho=tamanho
         )
         session.add(produto)
-        session.commit()
+        session.flush()
+        incrementar_versoes(session, 'produtos')
+        agendar_replicacao(session, 'produtos', [produto.id])
+        confirmar(session)
+        registrar_auditoria('criar', 'produtos', produto.id, {'nome': nome, 'tamanho': tamanho}, session=session)
         return True, produto.id
     except IntegrityError:
-        session.rollback()
+        desfazer(session)
         return False, "Já existe um produto com este nome e tamanho"
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao cadastrar produto: {e}")
         return False, str(e)
     finally:
-        session.close()
+        fechar_sessao(session)
 
 def get_produtos():
     if not SQLALCHEMY_AVAILABLE:
         return []
         
-    session = Session()
     try:
-        produtos = session.query(Produto).order_by(Produto.nome, Produto.tamanho).all()
-        return [(p.id, p.nome, p.descricao, p.preco, p.custo, p.estoque_minimo, p.tamanho, p.criado_em) for p in produtos]
+        return get_cache_dados().obter(('produtos',), None, lambda: executar_leitura(
+            select(Produto.id, Produto.nome, Produto.descricao, Produto.preco, Produto.custo,
+                   Produto.estoque_minimo, Produto.tamanho, Produto.criado_em)
+            .order_by(Produto.nome, Produto.tamanho)
+        ))
     except Exception as e:
         st.error(f"Erro ao buscar produtos: {e}")
         return []
-    finally:
-        session.close()
 
 # Funções de Gestão de Estoque
+def _vincular_escolas(session, produto_ids, quantidade_inicial=0, shard=None):
+    """INSERT ... SELECT único ligando os produtos a todas as escolas em que ainda não estão.
+
+    Com sharding, na sessão do principal só agenda o vínculo, feito em cada shard (`shard`) após o commit.
+    """
+    if not produto_ids:
+        return 0
+    if shard_engines and shard is None:
+        session.info.setdefault('replicar_shards', {}).setdefault('vincular', []).append(
+            (list(produto_ids), quantidade_inicial)
+        )
+        agendar_replicacao(session, 'produtos', produto_ids)
+        return 0
+    filtro = [Escola.id % len(shard_engines) == shard] if shard is not None else []
+    resultado = session.execute(
+        insert(EstoqueEscola).from_select(
+            ['escola_id', 'produto_id', 'quantidade', 'atualizado_em'],
+            select(Escola.id, Produto.id, literal(quantidade_inicial), literal(datetime.now()))
+            .join(Produto, true())
+            .where(Produto.id.in_(list(produto_ids)), *filtro)
+            .where(~exists().where(EstoqueEscola.escola_id == Escola.id,
+                                   EstoqueEscola.produto_id == Produto.id))
+        )
+    )
+    if resultado.rowcount:
+        incrementar_versoes(session, 'estoque')
+    return resultado.rowcount
+
 def vincular_produto_todas_escolas(produto_id, quantidade_inicial=0):
     if not SQLALCHEMY_AVAILABLE:
         st.error("Sistema de banco de dados não disponível")
         return False
         
-    session = Session()
+    session = abrir_sessao()
     try:
-        escolas = get_escolas()
-        for escola in escolas:
-            # Verificar se já existe
-            estoque = session.query(EstoqueEscola).filter_by(
-                escola_id=escola[0], produto_id=produto_id
-            ).first()
-            
-            if not estoque:
-                novo_estoque = EstoqueEscola(
-                    escola_id=escola[0],
-                    produto_id=produto_id,
-                    quantidade=quantidade_inicial
-                )
-                session.add(novo_estoque)
-        
-        session.commit()
+        _vincular_escolas(session, [produto_id], quantidade_inicial)
+        confirmar(session)
         return True
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao vincular produto: {e}")
         return False
     finally:
-        session.close()
+        fechar_sessao(session)
+
+def _insert_ignorando_duplicados(modelo):
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(modelo).on_conflict_do_nothing()
+    if engine.dialect.name == 'sqlite':
+        return sqlite.insert(modelo).on_conflict_do_nothing()
+    return insert(modelo)
+
+def importar_produtos(linhas, vincular=True, estoque_inicial=0):
+    """Importa produtos em lote. Reexecutar com a mesma entrada não duplica nem falha.
+
+    `linhas` são dicts com nome, descricao, preco, custo, estoque_minimo e tamanho.
+    Retorna dict com inseridos, existentes, invalidos e vinculos, ou None em caso de erro.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return None
+
+    validos = {}
+    invalidos = []
+    for linha in linhas:
+        minimo = linha.get('estoque_minimo')
+        if minimo is None or str(minimo).strip() == '':
+            minimo = 5
+        try:
+            produto = {
+                'nome': str(linha.get('nome') or '').strip(),
+                'descricao': str(linha.get('descricao') or '').strip(),
+                'preco': float(str(linha.get('preco') or 0).replace(',', '.')),
+                'custo': float(str(linha.get('custo') or 0).replace(',', '.')),
+                'estoque_minimo': int(float(str(minimo).replace(',', '.'))),
+                'tamanho': str(linha.get('tamanho') or '').strip(),
+            }
+        except ValueError:
+            invalidos.append(linha)
+            continue
+        if not produto['nome'] or not produto['tamanho'] or produto['preco'] <= 0:
+            invalidos.append(linha)
+            continue
+        validos.setdefault((produto['nome'], produto['tamanho']), produto)
+
+    if not validos:
+        return {'inseridos': 0, 'existentes': 0, 'invalidos': invalidos, 'vinculos': 0}
+
+    session = abrir_sessao()
+    try:
+        # Validação contra _nome_tamanho_uc em uma única consulta
+        nomes = list({nome for nome, _ in validos})
+        existentes = {
+            (nome, tamanho): produto_id
+            for produto_id, nome, tamanho in session.execute(
+                select(Produto.id, Produto.nome, Produto.tamanho).where(Produto.nome.in_(nomes))
+            )
+        }
+        novos = [produto for chave, produto in validos.items() if chave not in existentes]
+
+        if novos:
+            session.execute(_insert_ignorando_duplicados(Produto), novos)
+
+        produto_ids = [
+            produto_id
+            for produto_id, nome, tamanho in session.execute(
+                select(Produto.id, Produto.nome, Produto.tamanho).where(Produto.nome.in_(nomes))
+            )
+            if (nome, tamanho) in validos
+        ]
+        vinculos = _vincular_escolas(session, produto_ids, estoque_inicial) if vincular else 0
+
+        incrementar_versoes(session, 'produtos')
+        agendar_replicacao(session, 'produtos', produto_ids)
+        confirmar(session)
+        vinculos = session.info.pop('vinculos_shards', vinculos)
+        registrar_auditoria('importar_produtos', 'produtos', None, {'inseridos': len(novos), 'vinculos': vinculos},
+                            session=session)
+        return {
+            'inseridos': len(novos),
+            'existentes': len(validos) - len(novos),
+            'invalidos': invalidos,
+            'vinculos': vinculos,
+        }
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao importar produtos: {e}")
+        return None
+    finally:
+        fechar_sessao(session)
+
+def ler_catalogo_csv(conteudo):
+    """Lê um CSV de catálogo (cabeçalho: nome, descricao, preco, custo, estoque_minimo, tamanho)."""
+    texto = conteudo.decode('utf-8-sig') if isinstance(conteudo, bytes) else conteudo
+    delimitador = ';' if texto.splitlines()[0].count(';') > texto.splitlines()[0].count(',') else ','
+    leitor = csv.DictReader(StringIO(texto), delimiter=delimitador)
+    return [{(chave or '').strip().lower(): valor for chave, valor in linha.items()} for linha in leitor]
 
 def get_estoque_escola(escola_id):
     if not SQLALCHEMY_AVAILABLE:
         return []
         
-    session = Session()
+    shard = shard_da_escola(escola_id)
     try:
-        estoque_items = session.query(EstoqueEscola, Produto).join(
-            Produto, EstoqueEscola.produto_id == Produto.id
-        ).filter(EstoqueEscola.escola_id == escola_id).all()
-        
-        resultado = []
-        for estoque_item in estoque_items:
-            resultado.append((
-                estoque_item.EstoqueEscola.id, 
-                estoque_item.Produto.nome, 
-                estoque_item.Produto.tamanho, 
-                estoque_item.EstoqueEscola.quantidade, 
-                estoque_item.Produto.estoque_minimo,
-                estoque_item.Produto.preco,
-                estoque_item.Produto.custo,
-                estoque_item.Produto.id
-            ))
-        return resultado
+        return get_cache_dados(shard).obter(('estoque', 'produtos'), escola_id, lambda: executar_leitura(
+            select(EstoqueEscola.id, Produto.nome, Produto.tamanho, EstoqueEscola.quantidade,
+                   Produto.estoque_minimo, Produto.preco, Produto.custo, Produto.id.label('produto_id'),
+                   EstoqueEscola.versao)
+            .join(Produto, EstoqueEscola.produto_id == Produto.id)
+            .where(EstoqueEscola.escola_id == escola_id),
+            shard=shard
+        ))
     except Exception as e:
         st.error(f"Erro ao buscar estoque: {e}")
         return []
-    finally:
-        session.close()
 
-def update_estoque_escola(escola_id, produto_id, quantidade):
+def update_estoque_escola(escola_id, produto_id, quantidade, versao=None, vinculado=True):
+    """Define a quantidade absoluta. Com `versao`, só grava se o item não mudou desde a leitura;
+    com `vinculado=False` (item lido sem vínculo), só grava se ninguém o vinculou nesse meio tempo."""
     if not SQLALCHEMY_AVAILABLE:
         st.error("Sistema de banco de dados não disponível")
         return False
         
-    session = Session()
+    session = abrir_sessao(shard_da_escola(escola_id))
     try:
-        estoque = session.query(EstoqueEscola).filter_by(
-            escola_id=escola_id, produto_id=produto_id
+        atual = session.execute(
+            select(EstoqueEscola.id, EstoqueEscola.quantidade)
+            .where(EstoqueEscola.escola_id == escola_id, EstoqueEscola.produto_id == produto_id)
         ).first()
         
-        if estoque:
-            estoque.quantidade = quantidade
+        if atual and not vinculado:
+            desfazer(session)
+            st.warning(f"O item foi vinculado à escola por outra pessoa (agora: {atual.quantidade}). "
+                       "Confira a quantidade e tente novamente.")
+            return False
+        if atual:
+            estoque_id = atual.id
+            stmt = (update(EstoqueEscola)
+                    .where(EstoqueEscola.id == estoque_id)
+                    .values(quantidade=quantidade, versao=EstoqueEscola.versao + 1))
+            if versao is not None:
+                stmt = stmt.where(EstoqueEscola.versao == versao)
+            if session.execute(stmt).rowcount == 0:
+                desfazer(session)
+                st.warning(f"O estoque deste item foi alterado por outra pessoa (agora: {atual.quantidade}). "
+                           "Confira a quantidade e tente novamente.")
+                return False
         else:
             estoque = EstoqueEscola(
                 escola_id=escola_id,
@@ -385,204 +1569,1460 @@ def update_estoque_escola(escola_id, produto_id, quantidade):
                 quantidade=quantidade
             )
             session.add(estoque)
+            session.flush()
+            estoque_id = estoque.id
         
-        session.commit()
+        incrementar_versoes(session, 'estoque')
+        confirmar(session)
+        registrar_auditoria('ajustar_estoque', 'estoque_escolas', estoque_id,
+                            {'escola_id': escola_id, 'produto_id': produto_id, 'quantidade': quantidade},
+                            session=session)
         return True
+    except IntegrityError:
+        desfazer(session)
+        st.warning("O item foi vinculado à escola por outra pessoa. Confira a quantidade e tente novamente.")
+        return False
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao atualizar estoque: {e}")
         return False
     finally:
-        session.close()
+        fechar_sessao(session)
 
-# Funções de Gestão de Pedidos
-def add_pedido(cliente_id, escola_id, itens, desconto=0):
+def ajustar_estoque_escola(escola_id, produto_id, delta):
+    """Soma `delta` (positivo ou negativo) à quantidade no próprio banco, sem deixá-la negativa.
+    Retorna a nova quantidade."""
     if not SQLALCHEMY_AVAILABLE:
         st.error("Sistema de banco de dados não disponível")
         return None
         
-    session = Session()
+    session = abrir_sessao(shard_da_escola(escola_id))
     try:
-        # Calcular totais
-        total_venda = sum(item['quantidade'] * item['preco'] for item in itens)
-        total_custo = sum(item['quantidade'] * item['custo'] for item in itens)
-        total_com_desconto = total_venda - (total_venda * desconto / 100)
-        lucro_total = total_com_desconto - total_custo
-        margem_lucro = (lucro_total / total_com_desconto * 100) if total_com_desconto > 0 else 0
-        
-        # Criar pedido
-        pedido = Pedido(
-            cliente_id=cliente_id,
-            escola_id=escola_id,
-            total=total_com_desconto,
-            desconto=desconto,
-            custo_total=total_custo,
-            lucro_total=lucro_total,
-            margem_lucro=margem_lucro
-        )
-        session.add(pedido)
-        session.flush()  # Para obter o ID do pedido
-        
-        # Adicionar itens e atualizar estoque
-        for item in itens:
-            lucro_unitario = item['preco'] - item['custo']
-            margem_unitario = (lucro_unitario / item['preco'] * 100) if item['preco'] > 0 else 0
-            
-            item_pedido = ItemPedido(
-                pedido_id=pedido.id,
-                produto_id=item['produto_id'],
-                quantidade=item['quantidade'],
-                preco_unitario=item['preco'],
-                custo_unitario=item['custo'],
-                lucro_unitario=lucro_unitario,
-                margem_lucro=margem_unitario
-            )
-            session.add(item_pedido)
-            
-            # Atualizar estoque
-            estoque = session.query(EstoqueEscola).filter_by(
-                escola_id=escola_id, produto_id=item['produto_id']
-            ).first()
-            
-            if estoque:
-                estoque.quantidade -= item['quantidade']
+        condicao = (EstoqueEscola.escola_id == escola_id) & (EstoqueEscola.produto_id == produto_id)
+        somar = (update(EstoqueEscola).where(condicao, EstoqueEscola.quantidade + delta >= 0)
+                 .values(quantidade=EstoqueEscola.quantidade + delta, versao=EstoqueEscola.versao + 1))
+        ajustado = session.execute(somar).rowcount > 0
+        if not ajustado and delta > 0 and session.execute(select(EstoqueEscola.id).where(condicao)).first() is None:
+            try:
+                # savepoint: se outra pessoa vinculou o item ao mesmo tempo, soma o delta à linha dela
+                with session.begin_nested():
+                    session.add(EstoqueEscola(escola_id=escola_id, produto_id=produto_id, quantidade=delta))
+                ajustado = True
+            except IntegrityError:
+                ajustado = session.execute(somar).rowcount > 0
+        if not ajustado:
+            disponivel = session.execute(select(EstoqueEscola.quantidade).where(condicao)).scalar()
+            desfazer(session)
+            st.warning(f"Estoque insuficiente: há {disponivel or 0} unidade(s) e o ajuste é de {delta}.")
+            return None
         
-        session.commit()
-        return pedido.id
+        estoque_id, quantidade = session.execute(
+            select(EstoqueEscola.id, EstoqueEscola.quantidade).where(condicao)
+        ).one()
+        incrementar_versoes(session, 'estoque')
+        confirmar(session)
+        registrar_auditoria('ajustar_estoque', 'estoque_escolas', estoque_id,
+                            {'escola_id': escola_id, 'produto_id': produto_id, 'delta': delta, 'quantidade': quantidade},
+                            session=session)
+        return quantidade
     except Exception as e:
-        session.rollback()
+        desfazer(session)
+        st.error(f"Erro ao ajustar estoque: {e}")
+        return None
+    finally:
+        fechar_sessao(session)
+
+def get_grade_estoque(escola_id):
+    """Todos os produtos com a quantidade na escola (None quando ainda não vinculado)."""
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+        
+    try:
+        return executar_leitura(
+            select(Produto.id, Produto.nome, Produto.tamanho, EstoqueEscola.quantidade, Produto.estoque_minimo,
+                   EstoqueEscola.versao)
+            .outerjoin(EstoqueEscola, (EstoqueEscola.produto_id == Produto.id) & (EstoqueEscola.escola_id == escola_id))
+            .order_by(Produto.nome, Produto.tamanho),
+            shard=shard_da_escola(escola_id)
+        )
+    except Exception as e:
+        st.error(f"Erro ao buscar estoque: {e}")
+        return []
+
+def atualizar_estoque_lote(escola_id, quantidades, versoes=None):
+    """Grava {produto_id: quantidade} em uma única transação: um UPDATE em lote e um INSERT em lote.
+    
+    Com `versoes` ({produto_id: versao lida, None se não vinculado}), nada é gravado se algum item
+    mudou desde a leitura.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return False
+    if not quantidades:
+        return True
+        
+    session = abrir_sessao(shard_da_escola(escola_id))
+    try:
+        existentes = dict(session.execute(
+            select(EstoqueEscola.produto_id, EstoqueEscola.id)
+            .where(EstoqueEscola.escola_id == escola_id, EstoqueEscola.produto_id.in_(list(quantidades)))
+        ).all())
+        
+        atualizacoes = [{'b_id': existentes[produto_id], 'b_quantidade': quantidade,
+                         'b_versao': versoes.get(produto_id) if versoes is not None else None}
+                        for produto_id, quantidade in quantidades.items() if produto_id in existentes]
+        novos = [{'escola_id': escola_id, 'produto_id': produto_id, 'quantidade': quantidade}
+                 for produto_id, quantidade in quantidades.items() if produto_id not in existentes]
+        
+        conflitos = []
+        if versoes is not None:
+            # vinculado por outra pessoa depois da leitura
+            conflitos = [produto_id for produto_id in existentes if versoes.get(produto_id) is None]
+        
+        if atualizacoes and not conflitos:
+            stmt = (update(EstoqueEscola.__table__)
+                    .where(EstoqueEscola.id == bindparam('b_id'))
+                    .values(quantidade=bindparam('b_quantidade'), versao=EstoqueEscola.versao + 1))
+            if versoes is not None:
+                stmt = stmt.where(EstoqueEscola.versao == bindparam('b_versao'))
+            conexao = session.connection()
+            if versoes is None or conexao.dialect.supports_sane_multi_rowcount:
+                alteradas = conexao.execute(stmt, atualizacoes).rowcount
+            else:
+                alteradas = sum(conexao.execute(stmt, atualizacao).rowcount for atualizacao in atualizacoes)
+            if versoes is not None and alteradas != len(atualizacoes):
+                # desfaz o lote e identifica (fora dele) quais itens mudaram
+                desfazer(session)
+                atuais = dict(session.execute(
+                    select(EstoqueEscola.produto_id, EstoqueEscola.versao)
+                    .where(EstoqueEscola.escola_id == escola_id, EstoqueEscola.produto_id.in_(list(existentes)))
+                ).all())
+                conflitos = [produto_id for produto_id in existentes
+                             if atuais.get(produto_id) != versoes.get(produto_id)] or list(existentes)
+        
+        if conflitos:
+            desfazer(session)
+            st.warning(f"{len(conflitos)} item(ns) alterado(s) por outra pessoa desde a leitura "
+                       f"(produto(s) {sorted(conflitos)}). Nada foi gravado; recarregue a grade e confira.")
+            return False
+        
+        if novos:
+            session.execute(insert(EstoqueEscola), novos)
+        
+        incrementar_versoes(session, 'estoque')
+        confirmar(session)
+        registrar_auditoria('ajustar_estoque_lote', 'escolas', escola_id, {'quantidades': quantidades}, session=session)
+        return True
+    except IntegrityError:
+        desfazer(session)
+        st.warning("Algum item foi vinculado à escola por outra pessoa. Nada foi gravado; recarregue a grade e confira.")
+        return False
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao atualizar estoque: {e}")
+        return False
+    finally:
+        fechar_sessao(session)
+
+def ler_contagem_planilha(texto, produtos):
+    """Converte linhas coladas de planilha (Produto, Tamanho, Quantidade) em {produto_id: quantidade}.
+
+    Aceita tabulação (cópia direta do Excel/Sheets) ou ponto e vírgula como separador.
+    Retorna (quantidades, linhas_invalidas).
+    """
+    por_nome = {(p[1].strip().lower(), (p[6] or '').strip().lower()): p[0] for p in produtos}
+    quantidades = {}
+    invalidas = []
+    for linha in texto.splitlines():
+        if not linha.strip():
+            continue
+        campos = [c.strip() for c in linha.split('\t' if '\t' in linha else ';')]
+        try:
+            nome, tamanho, quantidade = campos[0], campos[1], int(float(campos[2].replace(',', '.')))
+        except (IndexError, ValueError):
+            invalidas.append(linha)
+            continue
+        produto_id = por_nome.get((nome.lower(), tamanho.lower()))
+        if produto_id is None or quantidade < 0:
+            invalidas.append(linha)
+        else:
+            quantidades[produto_id] = quantidade
+    return quantidades, invalidas
+
+# Funções de Gestão de Pedidos
+class EstoqueInsuficiente(Exception):
+    pass
+
+class EstoqueAlterado(Exception):
+    """O estoque mudou entre a conferência e a baixa; a transação inteira deve ser desfeita."""
+
+IDEMPOTENCIA_HORAS = 24   # prazo em que o reenvio de uma chave devolve o pedido já criado
+
+def nova_chave_idempotencia():
+    return uuid.uuid4().hex
+
+def _pedido_por_chave(session, chave):
+    """Pedido já criado com a chave dentro do prazo, como (id, total); chaves vencidas são liberadas."""
+    existente = session.execute(
+        select(Pedido.id, Pedido.total, Pedido.criado_em).where(Pedido.chave_idempotencia == chave)
+    ).first()
+    if existente is None:
+        return None
+    if existente.criado_em < datetime.now() - timedelta(hours=IDEMPOTENCIA_HORAS):
+        session.execute(
+            update(Pedido.__table__).where(Pedido.id == existente.id)
+            .values(chave_idempotencia=None, atualizado_em=Pedido.atualizado_em)
+        )
+        return None
+    return existente.id, existente.total
+
+def expirar_chaves_idempotencia(horas=IDEMPOTENCIA_HORAS):
+    """Libera em lote as chaves de pedidos fora do prazo. Retorna quantas foram liberadas."""
+    limite = datetime.now() - timedelta(hours=horas)
+    liberadas = 0
+    for motor in motores_escolas():
+        with motor.begin() as conn:
+            liberadas += conn.execute(
+                update(Pedido.__table__)
+                .where(Pedido.chave_idempotencia.isnot(None), Pedido.criado_em < limite)
+                .values(chave_idempotencia=None, atualizado_em=Pedido.atualizado_em)
+            ).rowcount
+    return liberadas
+
+def _inserir_pedido(session, cliente_id, escola_id, itens, desconto=0, verificar_estoque=False, chave=None):
+    """Insere pedido, itens, baixa de estoque e agregados na sessão informada (sem commit).
+    
+    O estoque de todas as linhas é lido em uma consulta; itens e baixas são gravados em lote.
+    Com `chave` já usada dentro do prazo, nada é gravado e o pedido existente é devolvido.
+    Retorna (pedido_id, total, criado).
+    """
+    if chave:
+        existente = _pedido_por_chave(session, chave)
+        if existente:
+            return existente[0], existente[1], False
+    
+    # Calcular totais
+    total_venda = sum(item['quantidade'] * item['preco'] for item in itens)
+    total_custo = sum(item['quantidade'] * item['custo'] for item in itens)
+    total_com_desconto = total_venda - (total_venda * desconto / 100)
+    lucro_total = total_com_desconto - total_custo
+    margem_lucro = (lucro_total / total_com_desconto * 100) if total_com_desconto > 0 else 0
+    
+    necessario = {}
+    for item in itens:
+        necessario[item['produto_id']] = necessario.get(item['produto_id'], 0) + item['quantidade']
+    estoques = dict(session.execute(
+        select(EstoqueEscola.produto_id, EstoqueEscola.quantidade).where(
+            EstoqueEscola.escola_id == escola_id,
+            EstoqueEscola.produto_id.in_(list(necessario))
+        )
+    ).all())
+    if verificar_estoque:
+        faltando = [produto_id for produto_id, quantidade in necessario.items()
+                    if produto_id not in estoques or estoques[produto_id] < quantidade]
+        if faltando:
+            raise EstoqueInsuficiente(f"Estoque insuficiente para o(s) produto(s) {faltando}")
+    
+    # Criar pedido
+    pedido = Pedido(
+        cliente_id=cliente_id,
+        escola_id=escola_id,
+        total=total_com_desconto,
+        desconto=desconto,
+        custo_total=total_custo,
+        lucro_total=lucro_total,
+        margem_lucro=margem_lucro,
+        chave_idempotencia=chave or None
+    )
+    session.add(pedido)
+    session.flush()  # Para obter o ID do pedido
+    
+    # Baixa em lote e atômica no banco (quantidade - n), sem sobrescrever ajustes feitos em paralelo
+    baixas = [{'b_produto': produto_id, 'b_quantidade': quantidade}
+              for produto_id, quantidade in necessario.items() if produto_id in estoques]
+    if baixas:
+        stmt = (update(EstoqueEscola.__table__)
+                .where(EstoqueEscola.escola_id == escola_id, EstoqueEscola.produto_id == bindparam('b_produto'))
+                .values(quantidade=EstoqueEscola.quantidade - bindparam('b_quantidade'),
+                        versao=EstoqueEscola.versao + 1))
+        if verificar_estoque:
+            stmt = stmt.where(EstoqueEscola.quantidade >= bindparam('b_quantidade'))
+        conexao = session.connection()
+        if not verificar_estoque or conexao.dialect.supports_sane_multi_rowcount:
+            alteradas = conexao.execute(stmt, baixas).rowcount
+        else:
+            alteradas = sum(conexao.execute(stmt, baixa).rowcount for baixa in baixas)
+        if verificar_estoque and alteradas != len(baixas):
+            raise EstoqueAlterado("O estoque mudou durante a gravação do pedido")
+        incrementar_versoes(session, 'estoque')
+    
+    # Itens em um único INSERT de várias linhas
+    linhas = []
+    for item in itens:
+        lucro_unitario = item['preco'] - item['custo']
+        linhas.append({
+            'pedido_id': pedido.id,
+            'produto_id': item['produto_id'],
+            'quantidade': item['quantidade'],
+            'preco_unitario': item['preco'],
+            'custo_unitario': item['custo'],
+            'lucro_unitario': lucro_unitario,
+            'margem_lucro': (lucro_unitario / item['preco'] * 100) if item['preco'] > 0 else 0,
+        })
+    session.execute(insert(ItemPedido), linhas)
+    
+    _acumular_agregado_cliente(session, cliente_id, total_com_desconto, +1,
+                               escola_id=escola_id, criado_em=pedido.criado_em)
+    return pedido.id, total_com_desconto, True
+
+def add_pedido(cliente_id, escola_id, itens, desconto=0, verificar_estoque=False, chave=None):
+    """Cria o pedido. Reenvios com a mesma `chave` devolvem o id do pedido já criado, sem efeitos."""
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return None
+        
+    session = abrir_sessao(shard_da_escola(escola_id))
+    try:
+        pedido_id, total, criado = _inserir_pedido(session, cliente_id, escola_id, itens, desconto,
+                                                   verificar_estoque, chave)
+        if not criado:
+            return pedido_id
+        confirmar(session)
+        registrar_auditoria('criar', 'pedidos', pedido_id, {
+            'cliente_id': cliente_id, 'escola_id': escola_id, 'total': total, 'itens': len(itens)
+        }, session=session)
+        return pedido_id
+    except IntegrityError:
+        # envio simultâneo com a mesma chave: o outro já gravou
+        desfazer(session)
+        existente = _pedido_por_chave(session, chave) if chave else None
+        if existente:
+            return existente[0]
+        st.error("Erro ao criar pedido: conflito de gravação, tente novamente")
+        return None
+    except (EstoqueInsuficiente, EstoqueAlterado) as e:
+        desfazer(session)
+        st.error(f"{e}. Confira as quantidades e tente novamente.")
+        return None
+    except Exception as e:
+        desfazer(session)
         st.error(f"Erro ao criar pedido: {e}")
         return None
     finally:
-        session.close()
+        fechar_sessao(session)
 
-def get_pedidos():
+# Fila local de pedidos (write-behind) para horários de pico
+FILA_PEDIDOS_PATH = os.environ.get('FILA_PEDIDOS_PATH', 'fila_pedidos.db')
+FILA_LOTE = 50
+FILA_INTERVALO = 2.0   # segundos entre verificações (e espera após falha do banco)
+
+class FilaPedidos:
+    """Outbox SQLite local: o pedido é gravado aqui na hora e uma thread o envia ao banco principal em lotes."""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        with self._conectar() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS fila_pedidos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'Pendente',
+                pedido_id INTEGER,
+                erro TEXT,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                criado_em TEXT NOT NULL,
+                processado_em TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_fila_pedidos_status ON fila_pedidos (status, id)")
+        self.evento = threading.Event()
+        self.thread = threading.Thread(target=self._executar, name='fila-pedidos', daemon=True)
+        self.thread.start()
+
+    def _conectar(self):
+        conn = sqlite3.connect(self.caminho, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def enfileirar(self, payload):
+        conn = self._conectar()
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO fila_pedidos (payload, criado_em) VALUES (?, ?)",
+                    (json.dumps(payload, default=str), datetime.now().isoformat(sep=' '))
+                )
+            self.evento.set()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def listar(self, limite=100):
+        conn = self._conectar()
+        try:
+            return conn.execute(
+                "SELECT id, status, pedido_id, erro, tentativas, criado_em, processado_em, payload "
+                "FROM fila_pedidos ORDER BY id DESC LIMIT ?", (limite,)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def pendentes(self):
+        conn = self._conectar()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM fila_pedidos WHERE status = 'Pendente'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _marcar(self, resultados):
+        conn = self._conectar()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE fila_pedidos SET status = ?, pedido_id = ?, erro = ?, tentativas = tentativas + 1, "
+                    "processado_em = ? WHERE id = ?",
+                    [(status, pedido_id, erro, datetime.now().isoformat(sep=' '), fila_id)
+                     for fila_id, status, pedido_id, erro in resultados]
+                )
+        finally:
+            conn.close()
+
+    def _processar(self, entradas):
+        """Processa as entradas em ordem, uma transação por banco (shard); rejeita as que não têm estoque."""
+        grupos = {}
+        for fila_id, payload in entradas:
+            grupos.setdefault(shard_da_escola(json.loads(payload)['escola_id']), []).append((fila_id, payload))
+        for shard, grupo in grupos.items():
+            self._processar_grupo(shard, grupo)
+
+    def _processar_grupo(self, shard, entradas):
+        resultados = []
+        criados = []
+        session = Session() if shard is None else sessoes_shard[shard]()
+        try:
+            for fila_id, payload in entradas:
+                dados = json.loads(payload)
+                try:
+                    pedido_id, total, criado = _inserir_pedido(session, dados['cliente_id'], dados['escola_id'],
+                                                               dados['itens'], dados['desconto'],
+                                                               verificar_estoque=True, chave=dados.get('chave'))
+                    resultados.append((fila_id, 'Processado', pedido_id, None))
+                    if criado:
+                        criados.append((dados, pedido_id, total))
+                except EstoqueInsuficiente as e:
+                    resultados.append((fila_id, 'Rejeitado', None, str(e)))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self._marcar(resultados)
+        for dados, pedido_id, total in criados:
+            registrar_auditoria('criar', 'pedidos', pedido_id, {
+                'cliente_id': dados['cliente_id'], 'escola_id': dados['escola_id'], 'total': total,
+                'itens': len(dados['itens']), 'fila': True
+            }, usuario=dados.get('usuario'))
+
+    def processar_pendentes(self):
+        while True:
+            conn = self._conectar()
+            try:
+                entradas = conn.execute(
+                    "SELECT id, payload FROM fila_pedidos WHERE status = 'Pendente' ORDER BY id LIMIT ?", (FILA_LOTE,)
+                ).fetchall()
+            finally:
+                conn.close()
+            if not entradas:
+                return
+            try:
+                self._processar(entradas)
+            except OperationalError:
+                raise  # banco indisponível: tenta de novo depois, mantendo a ordem
+            except Exception:
+                # Falha inesperada no lote: isola a entrada problemática processando uma a uma
+                for entrada in entradas:
+                    try:
+                        self._processar([entrada])
+                    except OperationalError:
+                        raise
+                    except Exception as e:
+                        self._marcar([(entrada[0], 'Erro', None, str(e))])
+
+    def _executar(self):
+        while True:
+            self.evento.wait(FILA_INTERVALO)
+            self.evento.clear()
+            try:
+                self.processar_pendentes()
+            except Exception:
+                time.sleep(FILA_INTERVALO)
+
+@st.cache_resource
+def get_fila_pedidos():
+    return FilaPedidos(FILA_PEDIDOS_PATH)
+
+def enfileirar_pedido(cliente_id, escola_id, itens, desconto=0, chave=None):
+    """Aceita o pedido na fila local imediatamente. Retorna o número na fila.
+    
+    A chave de idempotência vai junto, de modo que reprocessar a entrada não duplica o pedido.
+    """
+    try:
+        usuario = st.session_state.user[1] if st.session_state.get('user') else None
+    except Exception:
+        usuario = None
+    try:
+        return get_fila_pedidos().enfileirar({
+            'cliente_id': cliente_id,
+            'escola_id': escola_id,
+            'itens': itens,
+            'desconto': desconto,
+            'usuario': usuario,
+            'chave': chave or nova_chave_idempotencia(),
+        })
+    except Exception as e:
+        st.error(f"Erro ao enfileirar pedido: {e}")
+        return None
+
+def get_pedidos(incluir_arquivo=False):
     if not SQLALCHEMY_AVAILABLE:
         return []
         
-    session = Session()
     try:
-        pedidos_data = session.query(Pedido, Cliente, Escola).join(
-            Cliente, Pedido.cliente_id == Cliente.id
-        ).join(
-            Escola, Pedido.escola_id == Escola.id
-        ).order_by(Pedido.criado_em.desc()).all()
-        
-        resultado = []
-        for pedido_item in pedidos_data:
-            resultado.append((
-                pedido_item.Pedido.id, 
-                pedido_item.Pedido.cliente_id, 
-                pedido_item.Pedido.escola_id, 
-                pedido_item.Pedido.status,
-                pedido_item.Pedido.total, 
-                pedido_item.Pedido.desconto, 
-                pedido_item.Pedido.custo_total, 
-                pedido_item.Pedido.lucro_total,
-                pedido_item.Pedido.margem_lucro, 
-                pedido_item.Pedido.criado_em, 
-                pedido_item.Cliente.nome, 
-                pedido_item.Escola.nome
-            ))
-        return resultado
+        modelos = [Pedido, PedidoArquivo] if incluir_arquivo else [Pedido]
+        selects = [
+            select(modelo.id, modelo.cliente_id, modelo.escola_id, modelo.status,
+                   modelo.total, modelo.desconto, modelo.custo_total, modelo.lucro_total,
+                   modelo.margem_lucro, modelo.criado_em,
+                   Cliente.nome.label('cliente_nome'), Escola.nome.label('escola_nome'))
+            .join(Cliente, modelo.cliente_id == Cliente.id)
+            .join(Escola, modelo.escola_id == Escola.id)
+            for modelo in modelos
+        ]
+        if len(selects) == 1:
+            stmt = selects[0].order_by(Pedido.criado_em.desc())
+        else:
+            todos = union_all(*selects).subquery()
+            stmt = select(todos).order_by(todos.c.criado_em.desc())
+        pedidos = ler_todas_escolas(stmt)
+        if shard_engines:
+            pedidos.sort(key=lambda pedido: pedido.criado_em, reverse=True)
+        return pedidos
     except Exception as e:
         st.error(f"Erro ao buscar pedidos: {e}")
         return []
-    finally:
-        session.close()
 
-def update_pedido_status(pedido_id, novo_status):
+def update_pedido_status(pedido_id, novo_status, escola_id=None):
+    """Altera o status do pedido; com sharding, `escola_id` indica o banco em que ele está."""
     if not SQLALCHEMY_AVAILABLE:
         st.error("Sistema de banco de dados não disponível")
         return False
+    if shard_engines and escola_id is None:
+        st.error("Informe a escola do pedido para localizar o shard")
+        return False
         
-    session = Session()
+    session = abrir_sessao(shard_da_escola(escola_id))
     try:
         pedido = session.query(Pedido).filter_by(id=pedido_id).first()
         if pedido:
+            status_anterior = pedido.status
             pedido.status = novo_status
-            session.commit()
+            if (status_anterior == 'Cancelado') != (novo_status == 'Cancelado'):
+                # Recalcula o cliente inteiro: última compra e escolas dependem dos pedidos não cancelados
+                session.flush()
+                recalcular_agregados(session, [pedido.cliente_id])
+            confirmar(session)
+            registrar_auditoria('alterar_status', 'pedidos', pedido_id, {'de': status_anterior, 'para': novo_status},
+                                session=session)
             return True
         return False
     except Exception as e:
-        session.rollback()
+        desfazer(session)
         st.error(f"Erro ao atualizar status: {e}")
         return False
     finally:
-        session.close()
+        fechar_sessao(session)
+
+# Agregados de compras por cliente e segmentação RFM
+def _acumular_agregado_cliente(session, cliente_id, valor, sinal, escola_id=None, criado_em=None):
+    """Aplica um pedido (sinal +1) ou seu cancelamento (sinal -1) ao agregado, com UPDATE atômico."""
+    valores = {
+        'total_pedidos': ClienteAgregado.total_pedidos + sinal,
+        'valor_total': ClienteAgregado.valor_total + sinal * valor,
+    }
+    if criado_em is not None:
+        valores['ultima_compra'] = case(
+            (ClienteAgregado.ultima_compra.is_(None), criado_em),
+            (ClienteAgregado.ultima_compra < criado_em, criado_em),
+            else_=ClienteAgregado.ultima_compra
+        )
+    if escola_id is not None:
+        marcador = f',{escola_id},'
+        valores['escolas'] = case(
+            (ClienteAgregado.escolas.contains(marcador), ClienteAgregado.escolas),
+            else_=func.coalesce(ClienteAgregado.escolas, ',') + f'{escola_id},'
+        )
+
+    resultado = session.execute(
+        update(ClienteAgregado).where(ClienteAgregado.cliente_id == cliente_id).values(**valores)
+    )
+    if resultado.rowcount == 0 and sinal > 0:
+        session.add(ClienteAgregado(
+            cliente_id=cliente_id,
+            total_pedidos=1,
+            valor_total=valor,
+            primeira_compra=criado_em,
+            ultima_compra=criado_em,
+            escolas=f',{escola_id},' if escola_id is not None else ','
+        ))
+
+def reconstruir_agregados_clientes(cliente_ids=None):
+    """Recalcula os agregados a partir de pedidos e pedidos_arquivo (todos ou só de `cliente_ids`).
+
+    Com sharding, cada shard guarda os agregados dos pedidos das suas escolas.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return False
+
+    shards = range(len(shard_engines)) if shard_engines else [None]
+    return all(_reconstruir_agregados(shard, cliente_ids) for shard in shards)
+
+def _reconstruir_agregados(shard, cliente_ids):
+    session = abrir_sessao(shard)
+    try:
+        recalcular_agregados(session, cliente_ids)
+        confirmar(session)
+        return True
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao recalcular agregados: {e}")
+        return False
+    finally:
+        fechar_sessao(session)
+
+AgregadoCliente = namedtuple('AgregadoCliente', 'cliente_id total_pedidos valor_total primeira_compra ultima_compra escolas')
+
+def _somar_agregados(a, b):
+    """Junta os agregados de um cliente vindos de shards diferentes."""
+    escolas = sorted({e for e in (a.escolas or ',').split(',') + (b.escolas or ',').split(',') if e}, key=int)
+    return AgregadoCliente(
+        a.cliente_id,
+        (a.total_pedidos or 0) + (b.total_pedidos or 0),
+        (a.valor_total or 0) + (b.valor_total or 0),
+        min((d for d in (a.primeira_compra, b.primeira_compra) if d), default=None),
+        max((d for d in (a.ultima_compra, b.ultima_compra) if d), default=None),
+        ',' + ','.join(escolas) + ',',
+    )
+
+def get_agregados_clientes():
+    if not SQLALCHEMY_AVAILABLE:
+        return {}
+
+    try:
+        agregados = {}
+        for linha in ler_todas_escolas(
+            select(ClienteAgregado.cliente_id, ClienteAgregado.total_pedidos, ClienteAgregado.valor_total,
+                   ClienteAgregado.primeira_compra, ClienteAgregado.ultima_compra, ClienteAgregado.escolas)
+        ):
+            anterior = agregados.get(linha.cliente_id)
+            agregados[linha.cliente_id] = linha if anterior is None else _somar_agregados(anterior, linha)
+        return agregados
+    except Exception as e:
+        st.error(f"Erro ao buscar agregados de clientes: {e}")
+        return {}
+
+def _pontuar_quintil(valores):
+    """Nota 1..5 pela posição (rank percentual médio) de cada valor; valores iguais têm a mesma nota."""
+    if len(valores) == 0:
+        return np.array([], dtype=int)
+    _, inversos, contagens = np.unique(valores, return_inverse=True, return_counts=True)
+    inicio = np.cumsum(contagens) - contagens + 1
+    ranks = (inicio + (contagens - 1) / 2)[inversos]
+    return np.ceil(ranks / len(valores) * 5).astype(int)
+
+def segmentacao_rfm():
+    """Segmentação RFM de todos os clientes com compras, calculada em lote a partir dos agregados."""
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+
+    try:
+        if shard_engines:
+            nomes = {cliente[0]: cliente[1] for cliente in get_clientes()}
+            linhas = [(a.cliente_id, nomes[a.cliente_id], a.total_pedidos, a.valor_total, a.ultima_compra)
+                      for a in get_agregados_clientes().values() if a.total_pedidos > 0 and a.cliente_id in nomes]
+        else:
+            linhas = executar_leitura(
+                select(Cliente.id, Cliente.nome, ClienteAgregado.total_pedidos,
+                       ClienteAgregado.valor_total, ClienteAgregado.ultima_compra)
+                .join(ClienteAgregado, ClienteAgregado.cliente_id == Cliente.id)
+                .where(ClienteAgregado.total_pedidos > 0)
+            )
+    except Exception as e:
+        st.error(f"Erro ao calcular segmentação: {e}")
+        return []
+
+    if not linhas:
+        return []
+
+    agora = datetime.now()
+    recencia = np.array([(agora - (l[4] or agora)).total_seconds() for l in linhas], dtype=float)
+    frequencia = np.array([l[2] for l in linhas], dtype=float)
+    monetario = np.array([l[3] or 0 for l in linhas], dtype=float)
+
+    nota_r = _pontuar_quintil(-recencia)
+    nota_f = _pontuar_quintil(frequencia)
+    nota_m = _pontuar_quintil(monetario)
+
+    segmentos = np.select(
+        [(nota_r >= 4) & (nota_f >= 4),
+         (nota_r >= 3) & (nota_f >= 3),
+         (nota_r >= 4) & (nota_f <= 2),
+         (nota_r <= 2) & (nota_f >= 3),
+         (nota_r <= 2) & (nota_f <= 2)],
+        ['Campeões', 'Leais', 'Novos', 'Em risco', 'Perdidos'],
+        default='Precisam de atenção'
+    )
+
+    return [{
+        'Cliente': linha[1],
+        'Pedidos': int(frequencia[i]),
+        'Valor Total': round(float(monetario[i]), 2),
+        'Última Compra': linha[4],
+        'Dias sem comprar': int(recencia[i] // 86400),
+        'R': int(nota_r[i]), 'F': int(nota_f[i]), 'M': int(nota_m[i]),
+        'Segmento': str(segmentos[i]),
+    } for i, linha in enumerate(linhas)]
+
+# Funções de Gestão de Usuários
+def add_usuario(username, password, nivel):
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return False
+        
+    session = abrir_sessao()
+    try:
+        senha_hash = hash_password(password)
+        usuario = Usuario(
+            username=username,
+            password=senha_hash,
+            nivel=nivel
+        )
+        session.add(usuario)
+        session.flush()
+        usuario_id = usuario.id
+        confirmar(session)
+        registrar_auditoria('criar', 'usuarios', usuario_id, {'username': username, 'nivel': nivel}, session=session)
+        return True
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao criar usuário: {e}")
+        return False
+    finally:
+        fechar_sessao(session)
+
+def get_usuarios():
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+        
+    session = abrir_sessao()
+    try:
+        usuarios = session.query(Usuario).order_by(Usuario.username).all()
+        return [(u.id, u.username, u.nivel, u.criado_em) for u in usuarios]
+    except Exception as e:
+        st.error(f"Erro ao buscar usuários: {e}")
+        return []
+    finally:
+        fechar_sessao(session)
+
+# Sistema de IA
+def previsao_vendas():
+    meses = ['Próximo Mês', '2° Mês', '3° Mês', '4° Mês', '5° Mês', '6° Mês']
+    vendas = [12000, 15000, 18000, 22000, 25000, 29000]
+    return meses, vendas
+
+def alertas_estoque():
+    if not SQLALCHEMY_AVAILABLE:
+        return []
+        
+    try:
+        return ler_todas_escolas(
+            select(EstoqueEscola.escola_id, Escola.nome.label('escola_nome'), Produto.nome,
+                   Produto.tamanho, EstoqueEscola.quantidade, Produto.estoque_minimo)
+            .join(Produto, EstoqueEscola.produto_id == Produto.id)
+            .join(Escola, EstoqueEscola.escola_id == Escola.id)
+            .where(EstoqueEscola.quantidade <= Produto.estoque_minimo)
+        )
+    except Exception as e:
+        st.error(f"Erro ao buscar alertas: {e}")
+        return []
+
+# Planejamento de reposição por curva de tamanhos
+REPOSICAO_PESO_REDE = 10   # peças do modelo vendidas na escola para a curva própria valer tanto quanto a da rede
+
+def planejar_reposicao(dias_historico=90, dias_cobertura=30):
+    """Sugestão de compra para toda a rede em uma passada vetorizada (escola x produto).
+
+    A demanda de cada modelo (produto de mesmo nome) vem da venda do modelo na escola; sem vendas,
+    da média por escola na rede. Ela é distribuída entre os tamanhos por uma curva que mistura a da
+    escola e a da rede, pesando a da escola conforme o volume vendido (sem vendas na rede, divide
+    igualmente). Retorna (plano, lista_compra) como listas de dicts.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        return [], []
+
+    desde = datetime.now() - timedelta(days=dias_historico)
+    try:
+        with conexao_leitura() as conn:
+            escolas = conn.execute(select(Escola.id, Escola.nome).order_by(Escola.nome)).all()
+            produtos = conn.execute(
+                select(Produto.id, Produto.nome, Produto.tamanho, Produto.estoque_minimo, Produto.custo)
+                .order_by(Produto.nome, Produto.tamanho)
+            ).all()
+        estoques = ler_todas_escolas(
+            select(EstoqueEscola.escola_id, EstoqueEscola.produto_id, EstoqueEscola.quantidade)
+        )
+        vendas_agregadas = ler_todas_escolas(
+            select(Pedido.escola_id, ItemPedido.produto_id, func.sum(ItemPedido.quantidade))
+            .join(ItemPedido, ItemPedido.pedido_id == Pedido.id)
+            .where(Pedido.status != 'Cancelado', Pedido.criado_em >= desde)
+            .group_by(Pedido.escola_id, ItemPedido.produto_id)
+        )
+    except Exception as e:
+        st.error(f"Erro ao calcular reposição: {e}")
+        return [], []
+
+    if not escolas or not produtos:
+        return [], []
+
+    idx_escola = {e[0]: i for i, e in enumerate(escolas)}
+    idx_produto = {p[0]: j for j, p in enumerate(produtos)}
+    modelos = {}
+    grupo = np.array([modelos.setdefault(p[1], len(modelos)) for p in produtos])
+    minimo = np.array([p[3] or 0 for p in produtos], dtype=float)
+    custo = np.array([p[4] or 0 for p in produtos], dtype=float)
+
+    n_escolas, n_produtos = len(escolas), len(produtos)
+    estoque = np.zeros((n_escolas, n_produtos))
+    vinculado = np.zeros((n_escolas, n_produtos), dtype=bool)
+    vendas = np.zeros((n_escolas, n_produtos))
+    for escola_id, produto_id, quantidade in estoques:
+        if escola_id in idx_escola and produto_id in idx_produto:
+            estoque[idx_escola[escola_id], idx_produto[produto_id]] = quantidade or 0
+            vinculado[idx_escola[escola_id], idx_produto[produto_id]] = True
+    for escola_id, produto_id, quantidade in vendas_agregadas:
+        if escola_id in idx_escola and produto_id in idx_produto:
+            vendas[idx_escola[escola_id], idx_produto[produto_id]] = quantidade or 0
+
+    # Matriz produto -> modelo para somar tamanhos de um mesmo modelo
+    por_modelo = np.zeros((n_produtos, len(modelos)))
+    por_modelo[np.arange(n_produtos), grupo] = 1
+
+    vendas_modelo = vendas @ por_modelo                      # escola x modelo
+    vendas_modelo_produto = vendas_modelo[:, grupo]          # escola x produto (total do modelo)
+    rede = vendas.sum(axis=0)
+    rede_modelo = (rede @ por_modelo)[grupo]
+    uniforme = 1.0 / por_modelo.sum(axis=0)[grupo]
+
+    curva_rede = np.divide(rede, rede_modelo, out=np.broadcast_to(uniforme, rede.shape).copy(), where=rede_modelo > 0)
+    curva_escola = np.divide(vendas, vendas_modelo_produto, out=np.broadcast_to(curva_rede, vendas.shape).copy(),
+                             where=vendas_modelo_produto > 0)
+    peso_escola = vendas_modelo_produto / (vendas_modelo_produto + REPOSICAO_PESO_REDE)
+    curva = peso_escola * curva_escola + (1 - peso_escola) * curva_rede
+
+    # Escola sem venda do modelo: média por escola entre as que trabalham com ele
+    escolas_modelo = np.maximum(((vinculado @ por_modelo) > 0).sum(axis=0), 1)[grupo]
+    velocidade_modelo = np.where(vendas_modelo_produto > 0, vendas_modelo_produto,
+                                 rede_modelo / escolas_modelo) / dias_historico
+    velocidade = vendas / dias_historico
+    demanda = curva * velocidade_modelo * dias_cobertura
+    disponivel = np.clip(estoque, 0, None)
+    cobertura = np.divide(disponivel, velocidade, out=np.full(vendas.shape, np.inf), where=velocidade > 0)
+    sugestao = np.ceil(np.clip(demanda + minimo - disponivel, 0, None))
+    sugestao[~(vinculado | (vendas > 0))] = 0
+
+    plano = []
+    for i, j in zip(*np.nonzero(sugestao)):
+        plano.append({
+            'Escola': escolas[i][1],
+            'Produto': produtos[j][1],
+            'Tamanho': produtos[j][2],
+            'Estoque': int(estoque[i, j]),
+            'Vendidos': int(vendas[i, j]),
+            'Venda/dia': round(float(velocidade[i, j]), 2),
+            'Dias de cobertura': None if np.isinf(cobertura[i, j]) else round(float(cobertura[i, j]), 1),
+            'Curva (%)': round(float(curva[i, j]) * 100, 1),
+            'Sugestão': int(sugestao[i, j]),
+        })
+
+    total_produto = sugestao.sum(axis=0)
+    lista_compra = [{
+        'Produto': produtos[j][1],
+        'Tamanho': produtos[j][2],
+        'Quantidade': int(total_produto[j]),
+        'Custo estimado': round(float(total_produto[j] * custo[j]), 2),
+    } for j in np.nonzero(total_produto)[0]]
+
+    return plano, lista_compra
+
+# Arquivamento de pedidos finalizados
+ARQUIVO_DIAS = int(os.environ.get('ARQUIVO_DIAS', 365))
+ARQUIVO_LOTE = 500
+STATUS_FINALIZADOS = ('Entregue', 'Cancelado')
+
+def arquivar_pedidos(dias=ARQUIVO_DIAS, lote=ARQUIVO_LOTE):
+    """Move pedidos finalizados mais antigos que `dias` (e seus itens) para as tabelas de arquivo.
+
+    Cada lote roda em sua própria transação curta para não bloquear as vendas.
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return 0
+
+    limite = datetime.now() - timedelta(days=dias)
+    colunas_pedido = [c.name for c in Pedido.__table__.columns]
+    colunas_item = [c.name for c in ItemPedido.__table__.columns]
+    total = 0
+    try:
+        expirar_chaves_idempotencia()
+        for motor in motores_escolas():
+            while True:
+                with motor.begin() as conn:
+                    ids = conn.execute(
+                        select(Pedido.id)
+                        .where(Pedido.status.in_(STATUS_FINALIZADOS), Pedido.criado_em < limite)
+                        .order_by(Pedido.id)
+                        .limit(lote)
+                    ).scalars().all()
+                    if not ids:
+                        break
+
+                    agora = datetime.now()
+                    conn.execute(insert(PedidoArquivo).from_select(
+                        colunas_pedido + ['arquivado_em'],
+                        select(*Pedido.__table__.columns, literal(agora)).where(Pedido.id.in_(ids))
+                    ))
+                    conn.execute(insert(ItemPedidoArquivo).from_select(
+                        colunas_item + ['arquivado_em'],
+                        select(*ItemPedido.__table__.columns, literal(agora)).where(ItemPedido.pedido_id.in_(ids))
+                    ))
+                    # Exclusões registradas na mesma transação: exportações e backups incrementais
+                    # ficam sabendo que as linhas saíram das tabelas quentes
+                    itens_ids = conn.execute(select(ItemPedido.id).where(ItemPedido.pedido_id.in_(ids))).scalars().all()
+                    registrar_exclusoes(conn, ItemPedido.__tablename__, itens_ids)
+                    registrar_exclusoes(conn, Pedido.__tablename__, ids)
+                    conn.execute(ItemPedido.__table__.delete().where(ItemPedido.pedido_id.in_(ids)))
+                    conn.execute(Pedido.__table__.delete().where(Pedido.id.in_(ids)))
+                total += len(ids)
+        registrar_auditoria('arquivar_pedidos', 'pedidos', None, {'dias': dias, 'arquivados': total})
+        return total
+    except Exception as e:
+        st.error(f"Erro ao arquivar pedidos: {e}")
+        return total
+
+def contar_pedidos_arquivaveis(dias=ARQUIVO_DIAS):
+    if not SQLALCHEMY_AVAILABLE:
+        return 0
+
+    limite = datetime.now() - timedelta(days=dias)
+    try:
+        return sum(linha[0] for linha in ler_todas_escolas(
+            select(func.count(Pedido.id))
+            .where(Pedido.status.in_(STATUS_FINALIZADOS), Pedido.criado_em < limite)
+        ))
+    except Exception as e:
+        st.error(f"Erro ao contar pedidos: {e}")
+        return 0
+
+# Extratos por escola gerados em paralelo
+def _gerar_extrato_escola(database_url, escola_id, escola_nome, inicio, fim):
+    """Roda em um processo do pool: engine próprio e uma consulta em lote com todos os itens da escola."""
+    engine_extrato = create_engine(database_url, poolclass=NullPool)
+    try:
+        with engine_extrato.connect() as conn:
+            itens = conn.execute(union_all(*[
+                select(pedido.id, pedido.criado_em, pedido.status, Cliente.nome, Produto.nome, Produto.tamanho,
+                       item.quantidade, item.preco_unitario, pedido.desconto, pedido.total)
+                .join(item, item.pedido_id == pedido.id)
+                .join(Cliente, pedido.cliente_id == Cliente.id)
+                .join(Produto, item.produto_id == Produto.id)
+                .where(pedido.escola_id == escola_id, pedido.criado_em >= inicio, pedido.criado_em < fim)
+                for pedido, item in ((Pedido, ItemPedido), (PedidoArquivo, ItemPedidoArquivo))
+            ])).all()
+            estoque = conn.execute(
+                select(Produto.nome, Produto.tamanho, EstoqueEscola.quantidade, Produto.estoque_minimo)
+                .join(Produto, EstoqueEscola.produto_id == Produto.id)
+                .where(EstoqueEscola.escola_id == escola_id)
+                .order_by(Produto.nome, Produto.tamanho)
+            ).all()
+    finally:
+        engine_extrato.dispose()
+
+    itens.sort(key=lambda i: (i[1], i[0]))
+    totais_pedidos = {i[0]: (i[2], i[9] or 0) for i in itens}
+    total_vendido = sum(total for status, total in totais_pedidos.values() if status != 'Cancelado')
+    pecas = sum(i[6] or 0 for i in itens if i[2] != 'Cancelado')
+
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Pedido', 'Data', 'Status', 'Cliente', 'Produto', 'Tamanho', 'Quantidade',
+                     'Preco_Unitario', 'Desconto', 'Total_Pedido'])
+    for item in itens:
+        writer.writerow(item)
+
+    linhas_itens = ''.join(
+        '<tr>' + ''.join(f'<td>{html.escape(str(v))}</td>' for v in (
+            i[0], format_date_br(i[1]), i[2], i[3], i[4], i[5], i[6], f'R$ {i[7] or 0:.2f}'
+        )) + '</tr>' for i in itens
+    )
+    linhas_estoque = ''.join(
+        '<tr>' + ''.join(f'<td>{html.escape(str(v))}</td>' for v in e) + '</tr>' for e in estoque
+    )
+    periodo = f"{inicio.strftime('%d/%m/%Y')} a {(fim - timedelta(days=1)).strftime('%d/%m/%Y')}"
+    documento = f"""<!DOCTYPE html>
+<html lang="pt-BR"><head><meta charset="utf-8"><title>Extrato - {html.escape(escola_nome)}</title>
+<style>body{{font-family:sans-serif;margin:2em}}table{{border-collapse:collapse;width:100%;margin-bottom:2em}}
+td,th{{border:1px solid #ccc;padding:4px 8px;text-align:left}}th{{background:#eee}}</style></head>
+<body><h1>Extrato - {html.escape(escola_nome)}</h1>
+<p><b>Período:</b> {periodo}<br><b>Pedidos:</b> {len(totais_pedidos)}<br>
+<b>Peças vendidas:</b> {pecas}<br><b>Total vendido:</b> R$ {total_vendido:,.2f}</p>
+<h2>Itens</h2><table><tr><th>Pedido</th><th>Data</th><th>Status</th><th>Cliente</th><th>Produto</th>
+<th>Tamanho</th><th>Qtd</th><th>Preço</th></tr>{linhas_itens}</table>
+<h2>Posição de Estoque</h2><table><tr><th>Produto</th><th>Tamanho</th><th>Quantidade</th><th>Mínimo</th></tr>
+{linhas_estoque}</table></body></html>"""
+
+    return escola_id, escola_nome, output.getvalue(), documento
+
+def gerar_extratos_escolas(escolas, inicio, fim):
+    """Gera um extrato (CSV + HTML) por escola em um pool de processos e devolve um .zip em bytes."""
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return None
+
+    try:
+        urls = get_shard_database_urls()
+        tarefas = [(urls[shard_da_escola(e[0])] if urls else get_database_url(), e[0], e[1], inicio, fim)
+                   for e in escolas]
+        # fork não é seguro com as threads do servidor; forkserver/spawn importam o worker do módulo
+        metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        try:
+            with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                     mp_context=multiprocessing.get_context(metodo)) as pool:
+                extratos = list(pool.map(_gerar_extrato_escola, *zip(*tarefas)))
+        except (pickle.PicklingError, BrokenProcessPool, NotImplementedError, OSError):
+            # Worker não importável no processo filho ou sem suporte a processos: usa threads
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                extratos = list(pool.map(_gerar_extrato_escola, *zip(*tarefas)))
+    except Exception as e:
+        st.error(f"Erro ao gerar extratos: {e}")
+        return None
+
+    arquivo = BytesIO()
+    with zipfile.ZipFile(arquivo, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for escola_id, escola_nome, conteudo_csv, documento in extratos:
+            pasta = f"{escola_id}_{re.sub(r'[^A-Za-z0-9]+', '_', _normalizar_texto(escola_nome)).strip('_')}"
+            zf.writestr(f"{pasta}/extrato.csv", conteudo_csv)
+            zf.writestr(f"{pasta}/extrato.html", documento)
+    return arquivo.getvalue()
+
+# Exportação incremental (change data) por consumidor
+def get_watermark(consumidor, tabela):
+    if not SQLALCHEMY_AVAILABLE:
+        return None
+
+    try:
+        linhas = executar_leitura(
+            select(CursorExportacao.watermark)
+            .where(CursorExportacao.consumidor == consumidor, CursorExportacao.tabela == tabela),
+            primario=True
+        )
+        return linhas[0][0] if linhas else None
+    except Exception as e:
+        st.error(f"Erro ao buscar cursor de exportação: {e}")
+        return None
+
+def set_watermark(consumidor, tabela, watermark):
+    if not SQLALCHEMY_AVAILABLE:
+        st.error("Sistema de banco de dados não disponível")
+        return False
+
+    session = abrir_sessao()
+    try:
+        cursor = session.query(CursorExportacao).filter_by(consumidor=consumidor, tabela=tabela).first()
+        if cursor:
+            cursor.watermark = watermark
+        else:
+            session.add(CursorExportacao(consumidor=consumidor, tabela=tabela, watermark=watermark))
+        confirmar(session)
+        return True
+    except Exception as e:
+        desfazer(session)
+        st.error(f"Erro ao atualizar cursor de exportação: {e}")
+        return False
+    finally:
+        fechar_sessao(session)
+
+def cursores_exportacao(tabela):
+    """Chaves de cursor da tabela: uma por shard para as tabelas por escola, além da chave da própria tabela."""
+    if shard_engines and TABELAS_RASTREADAS[tabela].__table__ in TABELAS_POR_ESCOLA:
+        return [(shard, f'{tabela}@{shard}') for shard in range(len(shard_engines))]
+    return [(None, tabela)]
+
+def _exportar_origem(conn, modelo, tabela, desde, ate, writer, prefixo):
+    colunas = list(modelo.__table__.columns)
+    alteradas = excluidas = 0
+    filtro = [modelo.atualizado_em <= ate]
+    if desde is not None:
+        filtro.append(modelo.atualizado_em > desde)
+    resultado = conn.execute(
+        select(*colunas).where(*filtro).order_by(modelo.atualizado_em, modelo.id),
+        execution_options={'stream_results': True}
+    )
+    for linha in resultado:
+        writer.writerow(['upsert'] + prefixo + list(linha))
+        alteradas += 1
+
+    filtro = [RegistroExcluido.tabela == tabela, RegistroExcluido.excluido_em <= ate]
+    if desde is not None:
+        filtro.append(RegistroExcluido.excluido_em > desde)
+    resultado = conn.execute(
+        select(RegistroExcluido.registro_id, RegistroExcluido.excluido_em)
+        .where(*filtro).order_by(RegistroExcluido.excluido_em)
+    )
+    for registro_id, excluido_em in resultado:
+        linha = {c.name: None for c in colunas}
+        linha.update(id=registro_id, atualizado_em=excluido_em)
+        writer.writerow(['delete'] + prefixo + [linha[c.name] for c in colunas])
+        excluidas += 1
+    return alteradas, excluidas
+
+def exportar_alteracoes(consumidor, tabela):
+    """CSV com as linhas alteradas e excluídas desde o último watermark do consumidor.
+
+    Com sharding, as tabelas por escola são lidas de cada shard, com um cursor por shard e a coluna
+    Shard no CSV (os ids só são únicos dentro do shard).
+    Retorna (csv, alteradas, excluidas, watermark_anterior, watermark_novo) e avança o(s) cursor(es).
+    """
+    if not SQLALCHEMY_AVAILABLE:
+        return None
+
+    modelo = TABELAS_RASTREADAS[tabela]
+    cursores = cursores_exportacao(tabela)
+    por_shard = cursores[0][0] is not None
+    desde_tabela = get_watermark(consumidor, tabela)
+
+    try:
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Operacao'] + (['Shard'] if por_shard else []) + [c.name for c in modelo.__table__.columns])
+        alteradas = excluidas = 0
+        ate = datetime.now()
+        cortes = []
+        for shard, chave in cursores:
+            desde = get_watermark(consumidor, chave) if por_shard else desde_tabela
+            with (shard_engines[shard].connect() if por_shard else conexao_leitura(isolada=True)) as conn:
+                corte = corte_incremental(conn, ate)
+                linhas = _exportar_origem(conn, modelo, tabela, desde, corte, writer, [shard] if por_shard else [])
+            alteradas += linhas[0]
+            excluidas += linhas[1]
+            cortes.append((chave, corte))
+
+        for chave, corte in cortes:
+            if not set_watermark(consumidor, chave, corte):
+                return None
+        corte = min(c for _, c in cortes)
+        if por_shard and not set_watermark(consumidor, tabela, corte):
+            return None
+        return output.getvalue(), alteradas, excluidas, desde_tabela, corte
+    except Exception as e:
+        st.error(f"Erro ao exportar alterações: {e}")
+        return None
+
+# Backup e restauração online
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_PAGINAS = 256   # páginas SQLite copiadas por passo da API de backup
+BACKUP_LOTE = 1000     # linhas por lote no dump/restauração lógica
+
+def _json_default(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo não serializável: {type(valor)}")
+
+def _sha256_arquivo(arquivo, bloco=1024 * 1024):
+    sha = hashlib.sha256()
+    for pedaco in iter(lambda: arquivo.read(bloco), b''):
+        sha.update(pedaco)
+    return sha.hexdigest()
+
+def _backup_sqlite(zf):
+    """Cópia consistente do arquivo SQLite em passos de BACKUP_PAGINAS, sem bloquear escritores."""
+    fd, caminho_tmp = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        raw = engine.raw_connection()
+        try:
+            destino = sqlite3.connect(caminho_tmp)
+            try:
+                raw.driver_connection.backup(destino, pages=BACKUP_PAGINAS, sleep=0.005)
+            finally:
+                destino.close()
+        finally:
+            raw.close()
+
+        with open(caminho_tmp, 'rb') as origem, zf.open('banco.sqlite', 'w') as membro:
+            sha = hashlib.sha256()
+            for pedaco in iter(lambda: origem.read(1024 * 1024), b''):
+                sha.update(pedaco)
+                membro.write(pedaco)
+        return {'banco.sqlite': sha.hexdigest()}
+    finally:
+        os.remove(caminho_tmp)
 
-# Funções de Gestão de Usuários
-def add_usuario(username, password, nivel):
+def _tabelas_backup(shard):
+    """Tabelas do banco principal, ou as tabelas por escola (e as exclusões) de um shard."""
+    if shard is None:
+        return Base.metadata.sorted_tables
+    return [tabela for tabela in Base.metadata.sorted_tables
+            if tabela in TABELAS_POR_ESCOLA or tabela.name == RegistroExcluido.__tablename__]
+
+def _backup_logico(zf, ate, desde=None, shard=None):
+    """Dump em JSON lines, tabela a tabela, lendo em lotes (stream_results).
+
+    Com `desde`, as tabelas rastreadas trazem apenas linhas alteradas no intervalo e as exclusões.
+    Com `shard`, grava as tabelas por escola daquele shard em shards/<n>/.
+    Retorna (checksums, corte), com o corte recuado por corte_incremental.
+    """
+    checksums = {}
+    prefixo = '' if shard is None else f'shards/{shard}/'
+    with (conexao_leitura(isolada=True) if shard is None else shard_engines[shard].connect()) as conn:
+        ate = corte_incremental(conn, ate)
+        for tabela in _tabelas_backup(shard):
+            stmt = select(tabela)
+            if desde is not None and tabela.name in TABELAS_RASTREADAS:
+                stmt = stmt.where(tabela.c.atualizado_em > desde, tabela.c.atualizado_em <= ate)
+            elif desde is not None and tabela.name == RegistroExcluido.__tablename__:
+                stmt = stmt.where(tabela.c.excluido_em > desde, tabela.c.excluido_em <= ate)
+
+            sha = hashlib.sha256()
+            resultado = conn.execute(stmt, execution_options={'stream_results': True, 'yield_per': BACKUP_LOTE})
+            with zf.open(f'{prefixo}{tabela.name}.jsonl', 'w') as membro:
+                for lote in resultado.mappings().partitions():
+                    dados = ''.join(json.dumps(dict(linha), default=_json_default) + '\n'
+                                    for linha in lote).encode('utf-8')
+                    sha.update(dados)
+                    membro.write(dados)
+            checksums[f'{prefixo}{tabela.name}.jsonl'] = sha.hexdigest()
+    return checksums, ate
+
+def gerar_backup(incremental=False):
+    """Gera um .zip comprimido com manifest.json (SHA-256 de cada membro). Retorna (caminho, sha256).
+
+    Com sharding, inclui o dump lógico das tabelas por escola de cada shard, com um watermark por shard.
+    """
     if not SQLALCHEMY_AVAILABLE:
         st.error("Sistema de banco de dados não disponível")
-        return False
-        
-    session = Session()
+        return None
+
     try:
-        senha_hash = hash_password(password)
-        usuario = Usuario(
-            username=username,
-            password=senha_hash,
-            nivel=nivel
-        )
-        session.add(usuario)
-        session.commit()
-        return True
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        agora = datetime.now()
+        desde = get_watermark('backup', '*') if incremental else None
+        if incremental and desde is None:
+            incremental = False
+
+        if incremental:
+            formato = 'incremental'
+        elif engine.dialect.name == 'sqlite':
+            formato = 'sqlite'
+        else:
+            formato = 'logico'
+
+        caminho = os.path.join(BACKUP_DIR, f"backup_{formato}_{agora.strftime('%Y%m%d_%H%M%S')}.zip")
+        with zipfile.ZipFile(caminho, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            if formato == 'sqlite':
+                # a cópia tem tudo o que já foi confirmado; o próximo incremental reexporta a margem
+                checksums, corte = _backup_sqlite(zf), agora - timedelta(seconds=TRANSACAO_DURACAO_MAXIMA)
+            else:
+                checksums, corte = _backup_logico(zf, agora, desde=desde)
+            cortes_shards = []
+            for shard in range(len(shard_engines)):
+                desde_shard = get_watermark('backup', f'*@{shard}') if incremental else None
+                checksums_shard, corte_shard = _backup_logico(zf, agora, desde=desde_shard, shard=shard)
+                checksums.update(checksums_shard)
+                cortes_shards.append((f'*@{shard}', corte_shard))
+            manifesto = {
+                'formato': formato,
+                'dialeto': engine.dialect.name,
+                'criado_em': agora.isoformat(),
+                'desde': desde.isoformat() if desde else None,
+                'shards': len(shard_engines),
+                'arquivos': checksums,
+            }
+            zf.writestr('manifest.json', json.dumps(manifesto, indent=2))
+
+        set_watermark('backup', '*', corte)
+        for chave, corte_shard in cortes_shards:
+            set_watermark('backup', chave, corte_shard)
+        with open(caminho, 'rb') as arquivo:
+            return caminho, _sha256_arquivo(arquivo)
     except Exception as e:
-        session.rollback()
-        st.error(f"Erro ao criar usuário: {e}")
-        return False
-    finally:
-        session.close()
+        st.error(f"Erro ao gerar backup: {e}")
+        return None
 
-def get_usuarios():
-    if not SQLALCHEMY_AVAILABLE:
-        return []
-        
-    session = Session()
+def _converter_linha(tabela, linha):
+    for coluna in tabela.columns:
+        valor = linha.get(coluna.name)
+        if valor is not None and isinstance(coluna.type, DateTime):
+            linha[coluna.name] = datetime.fromisoformat(valor)
+    return linha
+
+def _restaurar_logico(zf, incremental, shard=None):
+    motor = engine if shard is None else shard_engines[shard]
+    prefixo = '' if shard is None else f'shards/{shard}/'
+    tabelas = _tabelas_backup(shard)
+    with motor.begin() as conn:
+        if not incremental:
+            for tabela in reversed(tabelas):
+                conn.execute(tabela.delete())
+
+        membros = set(zf.namelist())
+        for tabela in tabelas:
+            if f'{prefixo}{tabela.name}.jsonl' not in membros:  # backup anterior à criação da tabela
+                continue
+            with zf.open(f'{prefixo}{tabela.name}.jsonl') as membro:
+                lote = []
+                for linha in TextIOWrapper(membro, encoding='utf-8'):
+                    lote.append(_converter_linha(tabela, json.loads(linha)))
+                    if len(lote) >= BACKUP_LOTE:
+                        _inserir_lote(conn, tabela, lote, incremental)
+                        lote = []
+                if lote:
+                    _inserir_lote(conn, tabela, lote, incremental)
+
+        if incremental:
+            with zf.open(f'{prefixo}{RegistroExcluido.__tablename__}.jsonl') as membro:
+                for linha in TextIOWrapper(membro, encoding='utf-8'):
+                    exclusao = json.loads(linha)
+                    modelo = TABELAS_RASTREADAS.get(exclusao['tabela'])
+                    if modelo is not None and modelo.__table__ in tabelas:
+                        conn.execute(modelo.__table__.delete().where(modelo.id == exclusao['registro_id']))
+
+        if shard is not None:
+            conn.execute(update(VersaoDados).values(versao=VersaoDados.versao + 1))
+
+        ajustar_sequencias(conn, tabelas)
+
+def ajustar_sequencias(conn, tabelas):
+    """No PostgreSQL, avança as sequências dos ids após inserções com id explícito."""
+    if conn.dialect.name != 'postgresql':
+        return
+    for tabela in tabelas:
+        if 'id' not in tabela.c:
+            continue
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{tabela.name}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {tabela.name}), 1))"
+        ))
+
+def _upsert_pela_chave(dialeto, tabela):
+    """INSERT que sobrescreve a linha de mesma chave primária, sem apagá-la (preserva as FKs que apontam para ela)."""
+    if dialeto == 'postgresql':
+        stmt = postgresql.insert(tabela)
+    elif dialeto == 'sqlite':
+        stmt = sqlite.insert(tabela)
+    else:
+        raise NotImplementedError(f"Restauração incremental não suportada em {dialeto}")
+    chave = [coluna.name for coluna in tabela.primary_key.columns]
+    colunas = [coluna.name for coluna in tabela.columns if coluna.name not in chave]
+    if not colunas:
+        return stmt.on_conflict_do_nothing(index_elements=chave)
+    return stmt.on_conflict_do_update(index_elements=chave, set_={c: stmt.excluded[c] for c in colunas})
+
+def _inserir_lote(conn, tabela, lote, incremental):
+    if incremental:
+        conn.execute(_upsert_pela_chave(conn.dialect.name, tabela), lote)
+    else:
+        conn.execute(tabela.insert(), lote)
+
+def _restaurar_sqlite(zf):
+    fd, caminho_tmp = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
     try:
-        usuarios = session.query(Usuario).order_by(Usuario.username).all()
-        return [(u.id, u.username, u.nivel, u.criado_em) for u in usuarios]
-    except Exception as e:
-        st.error(f"Erro ao buscar usuários: {e}")
-        return []
+        with zf.open('banco.sqlite') as membro, open(caminho_tmp, 'wb') as destino:
+            for pedaco in iter(lambda: membro.read(1024 * 1024), b''):
+                destino.write(pedaco)
+
+        origem = sqlite3.connect(caminho_tmp)
+        raw = engine.raw_connection()
+        try:
+            origem.backup(raw.driver_connection, pages=BACKUP_PAGINAS, sleep=0.005)
+        finally:
+            raw.close()
+            origem.close()
+        engine.dispose()
     finally:
-        session.close()
+        os.remove(caminho_tmp)
 
-# Sistema de IA
-def previsao_vendas():
-    meses = ['Próximo Mês', '2° Mês', '3° Mês', '4° Mês', '5° Mês', '6° Mês']
-    vendas = [12000, 15000, 18000, 22000, 25000, 29000]
-    return meses, vendas
+def _avancar_versoes(anteriores):
+    """Após restaurar, deixa cada versão acima da anterior para que nenhum cache tome os dados restaurados por atuais."""
+    with engine.begin() as conn:
+        _garantir_versoes(conn)
+        for familia in FAMILIAS_DADOS:
+            anterior = anteriores.get(familia, 0)
+            conn.execute(
+                update(VersaoDados).where(VersaoDados.familia == familia)
+                .values(versao=case((VersaoDados.versao > anterior, VersaoDados.versao), else_=anterior) + 1)
+            )
+            if engine.dialect.name == 'postgresql':
+                conn.execute(select(func.pg_notify(CANAL_VERSOES, familia)))
+    get_cache_dados().invalidar()
 
-def alertas_estoque():
+def restaurar_backup(arquivo):
+    """Valida os checksums do manifesto e restaura o backup (caminho ou arquivo enviado)."""
     if not SQLALCHEMY_AVAILABLE:
-        return []
-        
-    session = Session()
+        st.error("Sistema de banco de dados não disponível")
+        return False
+
     try:
-        alertas_data = session.query(EstoqueEscola, Produto, Escola).join(
-            Produto, EstoqueEscola.produto_id == Produto.id
-        ).join(
-            Escola, EstoqueEscola.escola_id == Escola.id
-        ).filter(EstoqueEscola.quantidade <= Produto.estoque_minimo).all()
-        
-        resultado = []
-        for alerta_item in alertas_data:
-            resultado.append((
-                alerta_item.EstoqueEscola.escola_id, 
-                alerta_item.Escola.nome, 
-                alerta_item.Produto.nome, 
-                alerta_item.Produto.tamanho,
-                alerta_item.EstoqueEscola.quantidade, 
-                alerta_item.Produto.estoque_minimo
-            ))
-        return resultado
+        with zipfile.ZipFile(arquivo) as zf:
+            manifesto = json.loads(zf.read('manifest.json'))
+            for nome, checksum in manifesto['arquivos'].items():
+                with zf.open(nome) as membro:
+                    if _sha256_arquivo(membro) != checksum:
+                        st.error(f"Checksum inválido em {nome}. Backup corrompido.")
+                        return False
+
+            if manifesto['formato'] == 'sqlite' and engine.dialect.name != 'sqlite':
+                st.error("Backup SQLite só pode ser restaurado em banco SQLite")
+                return False
+            if manifesto.get('shards', 0) != len(shard_engines):
+                st.error(f"Backup gerado com {manifesto.get('shards', 0)} shard(s); configure o mesmo número "
+                         "em SHARD_DATABASE_URLS para restaurá-lo")
+                return False
+            
+            with engine.connect() as conn:
+                versoes_anteriores = dict(conn.execute(select(VersaoDados.familia, VersaoDados.versao)).all())
+            if manifesto['formato'] == 'sqlite':
+                _restaurar_sqlite(zf)
+                Base.metadata.create_all(engine)  # o arquivo pode ser de uma versão anterior do esquema
+                atualizar_estrutura_banco()
+            else:
+                _restaurar_logico(zf, incremental=manifesto['formato'] == 'incremental')
+            for shard in range(len(shard_engines)):
+                _restaurar_logico(zf, incremental=manifesto['formato'] == 'incremental', shard=shard)
+                get_cache_dados(shard).invalidar()
+            _avancar_versoes(versoes_anteriores)
+            sincronizar_shards()
+        registrar_auditoria('restaurar_backup', None, None, {'formato': manifesto['formato'],
+                                                             'criado_em': manifesto.get('criado_em')})
+        return True
     except Exception as e:
-        st.error(f"Erro ao buscar alertas: {e}")
+        st.error(f"Erro ao restaurar backup: {e}")
+        return False
+
+def listar_backups():
+    if not os.path.isdir(BACKUP_DIR):
         return []
-    finally:
-        session.close()
+    return sorted((nome for nome in os.listdir(BACKUP_DIR) if nome.endswith('.zip')), reverse=True)
 
 # Interface Principal
 def main():
@@ -604,15 +3044,16 @@ def main():
         """)
         return
         
-    init_db()
-    
-    if 'user' not in st.session_state:
-        st.session_state.user = None
-    
-    if not st.session_state.user:
-        show_login()
-    else:
-        show_main_app()
+    with unidade_de_trabalho():
+        init_db()
+        
+        if 'user' not in st.session_state:
+            st.session_state.user = None
+        
+        if not st.session_state.user:
+            show_login()
+        else:
+            show_main_app()
 
 def show_login():
     st.title("🔐 Sistema de Gestão - Login")
@@ -626,42 +3067,110 @@ def show_login():
             user = verify_login(username, password)
             if user:
                 st.session_state.user = (user.id, user.username, user.password, user.nivel)
+                registrar_auditoria('login', 'usuarios', user.id)
                 st.rerun()
             else:
+                registrar_auditoria('login_falhou', 'usuarios', None, usuario=username or None)
                 st.error("Usuário ou senha inválidos")
 
+# Perfil de páginas (somente administradores)
+PERFIL_EXECUCOES = 20   # reruns perfilados mantidos em memória
+PERFIL_TOP = 30         # funções com maior tempo acumulado guardadas por rerun
+PERFIL_CAMADAS = [
+    ('SQL', ('sqlalchemy/engine', 'sqlalchemy/pool', 'sqlalchemy/sql', 'sqlite3', 'psycopg2')),
+    ('ORM', ('sqlalchemy/orm',)),
+    ('Widgets', ('streamlit',)),
+    ('pandas/NumPy', ('pandas', 'numpy', 'pyarrow')),
+    ('Aplicação', (os.path.basename(__file__),)),
+]
+
+@st.cache_resource
+def get_perfis():
+    return deque(maxlen=PERFIL_EXECUCOES)
+
+def _camada(funcao):
+    arquivo, _, nome = funcao
+    origem = (arquivo if arquivo != '~' else nome).replace('\\', '/')
+    for camada, marcadores in PERFIL_CAMADAS:
+        if any(marcador in origem for marcador in marcadores):
+            return camada
+    return 'Outros'
+
+def perfilar_pagina(nome, pagina):
+    """Executa a página sob cProfile e guarda tempo, widgets e pontos quentes do rerun."""
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:  # outro perfilador ativo no processo
+        st.sidebar.caption("Perfilador ocupado em outra sessão")
+        pagina()
+        return
+    inicio = time.perf_counter()
+    try:
+        pagina()
+    finally:
+        perfil.disable()
+        duracao = time.perf_counter() - inicio
+        perfil.create_stats()
+        
+        camadas = {}
+        widgets = 0
+        for funcao, (_, chamadas, proprio, _, _) in perfil.stats.items():
+            camadas[_camada(funcao)] = camadas.get(_camada(funcao), 0) + proprio
+            if funcao[2] == '_enqueue' and funcao[0].endswith('delta_generator.py'):
+                widgets += chamadas
+        
+        estatisticas = pstats.Stats(perfil).sort_stats('cumulative')
+        pontos_quentes = []
+        for funcao in estatisticas.fcn_list[:PERFIL_TOP]:
+            _, chamadas, proprio, acumulado, _ = estatisticas.stats[funcao]
+            arquivo, linha, nome_funcao = funcao
+            pontos_quentes.append((f"{os.path.basename(arquivo)}:{linha}({nome_funcao})" if arquivo != '~' else nome_funcao,
+                                   chamadas, proprio, acumulado))
+        
+        get_perfis().append({
+            'inicio': get_brasil_datetime(),
+            'pagina': nome,
+            'usuario': st.session_state.user[1],
+            'duracao': duracao,
+            'widgets': widgets,
+            'camadas': camadas,
+            'pontos_quentes': pontos_quentes,
+            'prof': marshal.dumps(perfil.stats),
+        })
+
+def selecionar_aba(opcoes, chave):
+    """Seletor de seção no lugar de st.tabs: só a seção escolhida executa consultas e widgets."""
+    return st.radio("Seção", opcoes, horizontal=True, key=chave, label_visibility="collapsed")
+
 def show_main_app():
     st.sidebar.title(f"👋 Bem-vindo, {st.session_state.user[1]}")
     st.sidebar.write(f"**Nível:** {st.session_state.user[3]}")
     st.sidebar.write(f"**Data:** {format_date_br(get_brasil_datetime())}")
     
-    menu_options = ["📊 Dashboard", "👥 Gestão de Clientes", "🏫 Gestão de Escolas", 
-                   "📦 Gestão de Produtos", "📦 Sistema de Pedidos", "📈 Relatórios", "🤖 Sistema A.I."]
+    paginas = {
+        "📊 Dashboard": show_dashboard,
+        "👥 Gestão de Clientes": show_client_management,
+        "🏫 Gestão de Escolas": show_school_management,
+        "📦 Gestão de Produtos": show_product_management,
+        "📦 Sistema de Pedidos": show_order_management,
+        "📈 Relatórios": show_reports,
+        "🤖 Sistema A.I.": show_ai_system,
+    }
     
     if st.session_state.user[3] == 'admin':
-        menu_options.append("🔐 Administração")
+        paginas["🔐 Administração"] = show_admin_panel
     
-    choice = st.sidebar.selectbox("Navegação", menu_options)
+    choice = st.sidebar.selectbox("Navegação", list(paginas))
     
-    if choice == "📊 Dashboard":
-        show_dashboard()
-    elif choice == "👥 Gestão de Clientes":
-        show_client_management()
-    elif choice == "🏫 Gestão de Escolas":
-        show_school_management()
-    elif choice == "📦 Gestão de Produtos":
-        show_product_management()
-    elif choice == "📦 Sistema de Pedidos":
-        show_order_management()
-    elif choice == "📈 Relatórios":
-        show_reports()
-    elif choice == "🤖 Sistema A.I.":
-        show_ai_system()
-    elif choice == "🔐 Administração":
-        show_admin_panel()
+    if st.session_state.user[3] == 'admin' and st.sidebar.checkbox("🔬 Perfilar páginas", key="perfilar"):
+        perfilar_pagina(choice, paginas[choice])
+    else:
+        paginas[choice]()
     
     st.sidebar.markdown("---")
     if st.sidebar.button("🚪 Sair"):
+        registrar_auditoria('logout', 'usuarios', st.session_state.user[0])
         st.session_state.user = None
         st.rerun()
 
@@ -689,9 +3198,9 @@ def show_dashboard():
 def show_client_management():
     st.title("👥 Gestão de Clientes")
     
-    tab1, tab2 = st.tabs(["Cadastrar Cliente", "Lista de Clientes"])
+    aba = selecionar_aba(["Cadastrar Cliente", "Lista de Clientes", "Análise RFM", "Duplicados"], "aba_clientes")
     
-    with tab1:
+    if aba == "Cadastrar Cliente":
         st.subheader("Novo Cliente")
         with st.form("novo_cliente"):
             nome = st.text_input("Nome Completo *")
@@ -709,9 +3218,10 @@ def show_client_management():
                 else:
                     st.error("Nome é obrigatório")
     
-    with tab2:
+    if aba == "Lista de Clientes":
         st.subheader("Lista de Clientes")
         clientes = get_clientes()
+        agregados = get_agregados_clientes()
         
         for cliente in clientes:
             with st.expander(f"{cliente[1]} - {cliente[4] or 'Sem CPF'}"):
@@ -719,13 +3229,81 @@ def show_client_management():
                 st.write(f"**Email:** {cliente[3]}")
                 st.write(f"**Endereço:** {cliente[5]}")
                 st.write(f"**Cadastrado em:** {format_date_br(cliente[6])}")
+                
+                agregado = agregados.get(cliente[0])
+                if agregado and agregado.total_pedidos:
+                    st.write(f"**Pedidos:** {agregado.total_pedidos} - **Total comprado:** R$ {agregado.valor_total:,.2f}")
+                    st.write(f"**Última compra:** {format_date_br(agregado.ultima_compra)}")
+                else:
+                    st.write("**Pedidos:** nenhum")
+    
+    if aba == "Análise RFM":
+        st.subheader("Segmentação RFM")
+        st.caption("Recência, frequência e valor de compra, com notas de 1 a 5 por quintil.")
+        
+        rfm = segmentacao_rfm()
+        if not rfm:
+            st.info("Nenhum cliente com compras registradas.")
+        else:
+            df_rfm = pd.DataFrame(rfm)
+            resumo = df_rfm.groupby('Segmento').agg(
+                Clientes=('Cliente', 'count'), Valor=('Valor Total', 'sum')
+            ).reset_index()
+            st.dataframe(resumo, hide_index=True, use_container_width=True)
+            
+            segmento = st.selectbox("Segmento", ["Todos"] + sorted(df_rfm['Segmento'].unique()))
+            if segmento != "Todos":
+                df_rfm = df_rfm[df_rfm['Segmento'] == segmento]
+            st.dataframe(df_rfm, hide_index=True, use_container_width=True)
+        
+        if st.button("Recalcular Agregados"):
+            if reconstruir_agregados_clientes():
+                st.success("Agregados de clientes recalculados!")
+                st.rerun()
+    
+    if aba == "Duplicados":
+        st.subheader("Clientes Duplicados")
+        st.caption("Compara clientes com mesmo CPF, telefone ou nome de som parecido.")
+        
+        limiar = st.slider("Similaridade mínima", min_value=0.5, max_value=1.0, value=DUPLICADOS_LIMIAR, step=0.05)
+        if st.button("Procurar Duplicados"):
+            st.session_state.duplicados = encontrar_clientes_duplicados(limiar)
+        
+        grupos = st.session_state.get('duplicados')
+        if grupos is not None:
+            if not grupos:
+                st.success("✅ Nenhum duplicado encontrado")
+            else:
+                st.write(f"**{len(grupos)} grupo(s) de possíveis duplicados**")
+                por_id = {c[0]: c for c in get_clientes()}
+                agregados = get_agregados_clientes()
+                
+                for n, grupo in enumerate(grupos):
+                    ids = [cliente_id for cliente_id in grupo['ids'] if cliente_id in por_id]
+                    if len(ids) < 2:
+                        continue
+                    with st.expander(f"{por_id[ids[0]][1]} - {len(ids)} cadastros - similaridade {grupo['pontuacao']:.0%}"):
+                        opcoes = []
+                        for cliente_id in ids:
+                            cliente = por_id[cliente_id]
+                            agregado = agregados.get(cliente_id)
+                            opcoes.append(f"{cliente_id} - {cliente[1]} | Tel: {cliente[2] or '-'} | CPF: {cliente[4] or '-'} "
+                                          f"| Pedidos: {agregado.total_pedidos if agregado else 0}")
+                        principal = st.radio("Manter cadastro", opcoes, key=f"principal_{n}")
+                        
+                        if st.button("Mesclar", key=f"mesclar_{n}"):
+                            principal_id = int(principal.split(' - ')[0])
+                            if mesclar_clientes(principal_id, ids):
+                                st.success("Clientes mesclados com sucesso!")
+                                st.session_state.duplicados = [g for g in grupos if g is not grupo]
+                                st.rerun()
 
 def show_school_management():
     st.title("🏫 Gestão de Escolas")
     
-    tab1, tab2, tab3 = st.tabs(["Cadastrar Escola", "Lista de Escolas", "Estoque por Escola"])
+    aba = selecionar_aba(["Cadastrar Escola", "Lista de Escolas", "Estoque por Escola"], "aba_escolas")
     
-    with tab1:
+    if aba == "Cadastrar Escola":
         st.subheader("Nova Escola Parceira")
         with st.form("nova_escola"):
             nome = st.text_input("Nome da Escola *")
@@ -743,7 +3321,7 @@ def show_school_management():
                 else:
                     st.error("Nome da escola é obrigatório")
     
-    with tab2:
+    if aba == "Lista de Escolas":
         st.subheader("Escolas Parceiras")
         escolas = get_escolas()
         
@@ -755,7 +3333,7 @@ def show_school_management():
                 st.write(f"**Responsável:** {escola[5]}")
                 st.write(f"**Cadastrado em:** {format_date_br(escola[6])}")
     
-    with tab3:
+    if aba == "Estoque por Escola":
         st.subheader("Estoque por Escola")
         escolas = get_escolas()
         produtos = get_produtos()
@@ -779,20 +3357,77 @@ def show_school_management():
             
             estoque = get_estoque_escola(escola_id)
             
+            # A grade editada é comparada com o que foi lido (e com a versão lida), não com o banco de agora
+            chave_base = f"grade_base_{escola_id}"
+            if chave_base not in st.session_state:
+                st.session_state[chave_base] = (datetime.now(), [tuple(g) for g in get_grade_estoque(escola_id)])
+            lida_em, grade = st.session_state[chave_base]
+            carregado = {g[0]: g[3] if g[3] is not None else 0 for g in grade}
+            versoes = {g[0]: g[5] for g in grade}
+            
+            def recarregar_grade():
+                st.session_state.pop(chave_base, None)
+            
+            df_grade = pd.DataFrame([{
+                'produto_id': g[0],
+                'Produto': g[1],
+                'Tamanho': g[2],
+                'Quantidade': g[3] if g[3] is not None else 0,
+                'Mínimo': g[4],
+                'Abaixo do mínimo': g[3] is not None and g[3] <= g[4],
+            } for g in grade])
+            
             if not estoque:
-                st.info("Nenhum produto vinculado a esta escola ainda.")
-            else:
-                for item in estoque:
-                    col1, col2, col3 = st.columns([3, 1, 1])
-                    with col1:
-                        st.write(f"**{item[1]}** - Tamanho: {item[2]}")
-                    with col2:
-                        st.write(f"**Estoque:** {item[3]}")
-                    with col3:
-                        if item[3] <= item[4]:
-                            st.error(f"⚠️ Mín: {item[4]}")
-                        else:
-                            st.success(f"✅ Mín: {item[4]}")
+                st.info("Nenhum produto vinculado a esta escola ainda. Informe as quantidades na grade para vincular.")
+            
+            col_lida, col_recarregar = st.columns([3, 1])
+            col_lida.caption(f"Grade lida às {lida_em.strftime('%H:%M:%S')}")
+            if col_recarregar.button("Recarregar grade", key=f"recarregar_grade_{escola_id}"):
+                recarregar_grade()
+                st.rerun()
+            
+            df_editado = st.data_editor(
+                df_grade,
+                hide_index=True,
+                use_container_width=True,
+                disabled=['Produto', 'Tamanho', 'Mínimo', 'Abaixo do mínimo'],
+                column_config={
+                    'produto_id': None,
+                    'Quantidade': st.column_config.NumberColumn('Quantidade', min_value=0, step=1, required=True),
+                },
+                key=f"grade_estoque_{escola_id}_{lida_em.timestamp()}"
+            )
+            
+            vazias = df_editado['Quantidade'].isna()
+            if vazias.any():
+                st.warning(f"{int(vazias.sum())} linha(s) sem quantidade serão ignoradas: "
+                           + ", ".join(df_editado.loc[vazias, 'Produto'].astype(str).head(10)))
+            alteracoes = {
+                int(linha['produto_id']): int(linha['Quantidade'])
+                for _, linha in df_editado[~vazias].iterrows()
+                if carregado.get(int(linha['produto_id'])) != int(linha['Quantidade'])
+            }
+            
+            if st.button(f"Salvar Alterações ({len(alteracoes)})", disabled=not alteracoes,
+                         key=f"salvar_grade_{escola_id}"):
+                if atualizar_estoque_lote(escola_id, alteracoes, versoes):
+                    st.success(f"{len(alteracoes)} item(ns) de estoque atualizado(s)!")
+                    recarregar_grade()
+                    st.rerun()
+            
+            with st.expander("Colar contagem de planilha"):
+                st.caption("Uma linha por item: Produto, Tamanho e Quantidade, separados por tabulação ou ponto e vírgula.")
+                texto_planilha = st.text_area("Contagem", key=f"planilha_{escola_id}")
+                
+                if st.button("Aplicar Contagem", key=f"aplicar_planilha_{escola_id}"):
+                    quantidades, invalidas = ler_contagem_planilha(texto_planilha, produtos)
+                    alteracoes_planilha = {produto_id: quantidade for produto_id, quantidade in quantidades.items()
+                                           if carregado.get(produto_id) != quantidade}
+                    if invalidas:
+                        st.warning(f"{len(invalidas)} linha(s) ignorada(s): " + " | ".join(invalidas[:10]))
+                    if atualizar_estoque_lote(escola_id, alteracoes_planilha, versoes):
+                        st.success(f"{len(alteracoes_planilha)} item(ns) alterado(s) de {len(quantidades)} lido(s)")
+                        recarregar_grade()
             
             st.markdown("---")
             st.subheader("Ajustar Estoque")
@@ -803,28 +3438,60 @@ def show_school_management():
             if produto_ajuste:
                 produto_id = int(produto_ajuste.split(' - ')[0])
                 
-                estoque_atual = 0
-                for item in estoque:
-                    if item[7] == produto_id:
-                        estoque_atual = item[3]
-                        break
+                # Quantidade e versão do momento em que o valor foi exibido
+                chave_versao = f"versao_ajuste_{escola_id}_{produto_id}"
+                if chave_versao not in st.session_state:
+                    st.session_state[chave_versao] = next(
+                        ((item[3], item[8]) for item in estoque if item[7] == produto_id), (0, None)
+                    )
+                estoque_atual, versao_lida = st.session_state[chave_versao]
+                chave_ajuste = f"ajuste_{escola_id}_{produto_id}_{versao_lida}"
                 
-                nova_quantidade = st.number_input("Nova quantidade", 
-                                                 min_value=0, 
-                                                 value=estoque_atual,
-                                                 key=f"ajuste_{produto_id}")
+                def descartar_leitura():
+                    st.session_state.pop(chave_versao, None)
+                    st.session_state.pop(chave_base, None)
                 
-                if st.button("Atualizar Estoque", key=f"btn_ajuste_{produto_id}"):
-                    if update_estoque_escola(escola_id, produto_id, nova_quantidade):
-                        st.success(f"Estoque atualizado para {nova_quantidade}!")
-                        st.rerun()
+                modo_ajuste = st.radio("Tipo de ajuste", ["Definir quantidade", "Somar / subtrair"],
+                                       horizontal=True, key=f"modo_ajuste_{escola_id}")
+                
+                if modo_ajuste == "Definir quantidade":
+                    nova_quantidade = st.number_input("Nova quantidade", 
+                                                     min_value=0, 
+                                                     value=estoque_atual,
+                                                     key=chave_ajuste)
+                    
+                    if st.button("Atualizar Estoque", key=f"btn_{chave_ajuste}"):
+                        if update_estoque_escola(escola_id, produto_id, nova_quantidade, versao_lida,
+                                                 vinculado=versao_lida is not None):
+                            st.success(f"Estoque atualizado para {nova_quantidade}!")
+                            descartar_leitura()
+                            st.rerun()
+                        else:
+                            descartar_leitura()
+                else:
+                    quantidade_atual = next((item[3] for item in estoque if item[7] == produto_id), 0)
+                    st.caption(f"Quantidade atual: {quantidade_atual}")
+                    texto_delta = st.text_input("Ajuste (ex.: +12 ou -3)", key=f"delta_{escola_id}_{produto_id}")
+                    
+                    if st.button("Aplicar Ajuste", key=f"btn_delta_{escola_id}_{produto_id}"):
+                        try:
+                            delta = int(texto_delta.replace(' ', ''))
+                        except ValueError:
+                            delta = 0
+                        if not delta:
+                            st.error("Informe um ajuste diferente de zero, como +12 ou -3")
+                        else:
+                            nova = ajustar_estoque_escola(escola_id, produto_id, delta)
+                            if nova is not None:
+                                st.success(f"Estoque ajustado em {delta:+d}; quantidade agora: {nova}")
+                                descartar_leitura()
 
 def show_product_management():
     st.title("📦 Gestão de Produtos")
     
-    tab1, tab2 = st.tabs(["Cadastrar Produto", "Lista de Produtos"])
+    aba = selecionar_aba(["Cadastrar Produto", "Lista de Produtos", "Importar Catálogo"], "aba_produtos")
     
-    with tab1:
+    if aba == "Cadastrar Produto":
         st.subheader("Novo Produto")
         with st.form("novo_produto"):
             nome = st.text_input("Nome do Produto *")
@@ -852,15 +3519,22 @@ def show_product_management():
             
             if st.form_submit_button("Cadastrar Produto"):
                 if nome and preco > 0 and tamanho:
-                    sucesso, resultado = add_produto(nome, descricao, preco, custo, estoque_minimo, tamanho)
+                    # Cadastro e vínculo com as escolas em um único commit
+                    try:
+                        with transacao():
+                            sucesso, resultado = add_produto(nome, descricao, preco, custo, estoque_minimo, tamanho)
+                            vincular = sucesso and vincular_escolas and escolas
+                            if vincular:
+                                vincular_produto_todas_escolas(resultado, estoque_inicial)
+                    except LoteDesfeito:
+                        if sucesso:
+                            sucesso, resultado = False, "Produto não cadastrado: erro ao vincular às escolas"
                     
                     if sucesso:
                         st.success("Produto cadastrado com sucesso!")
                         
-                        if vincular_escolas and escolas:
-                            produto_id = resultado
-                            if vincular_produto_todas_escolas(produto_id, estoque_inicial):
-                                st.success(f"Produto vinculado automaticamente a {len(escolas)} escolas!")
+                        if vincular:
+                            st.success(f"Produto vinculado automaticamente a {len(escolas)} escolas!")
                         
                         if preco > 0 and custo > 0:
                             margem = ((preco - custo) / preco) * 100
@@ -870,7 +3544,7 @@ def show_product_management():
                 else:
                     st.error("Nome, preço e tamanho são obrigatórios")
     
-    with tab2:
+    if aba == "Lista de Produtos":
         st.subheader("Lista de Produtos")
         produtos = get_produtos()
         
@@ -886,13 +3560,58 @@ def show_product_management():
                     lucro_unitario = produto[3] - produto[4]
                     st.write(f"**Margem:** {margem:.1f}%")
                     st.write(f"**Lucro Unitário:** R$ {lucro_unitario:.2f}")
+    
+    if aba == "Importar Catálogo":
+        st.subheader("Importar Catálogo")
+        modo = st.radio("Origem", ["Produto com grade de tamanhos", "Arquivo CSV"], horizontal=True)
+        
+        linhas = []
+        if modo == "Produto com grade de tamanhos":
+            nome = st.text_input("Nome do Produto *", key="grade_nome")
+            descricao = st.text_area("Descrição", key="grade_descricao")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                preco = st.number_input("Preço de Venda (R$)", min_value=0.0, value=0.0, step=0.01, key="grade_preco")
+            with col2:
+                custo = st.number_input("Custo (R$)", min_value=0.0, value=0.0, step=0.01, key="grade_custo")
+            with col3:
+                estoque_minimo = st.number_input("Estoque Mínimo", min_value=0, value=5, key="grade_minimo")
+            tamanhos = st.multiselect("Tamanhos *", ["PP", "P", "M", "G", "GG", "EXG", "2", "4", "6", "8",
+                                                     "10", "12", "14", "16", "Único"])
+            if nome and tamanhos:
+                linhas = [{'nome': nome, 'descricao': descricao, 'preco': preco, 'custo': custo,
+                           'estoque_minimo': estoque_minimo, 'tamanho': tamanho} for tamanho in tamanhos]
+        else:
+            st.caption("Colunas: nome, descricao, preco, custo, estoque_minimo, tamanho (separador vírgula ou ponto e vírgula)")
+            arquivo = st.file_uploader("Catálogo CSV", type=["csv"])
+            if arquivo:
+                try:
+                    linhas = ler_catalogo_csv(arquivo.getvalue())
+                except Exception as e:
+                    st.error(f"Erro ao ler CSV: {e}")
+        
+        if linhas:
+            st.write(f"**{len(linhas)} produto(s) a importar**")
+            st.dataframe(pd.DataFrame(linhas), hide_index=True, use_container_width=True)
+        
+        vincular = st.checkbox("Vincular a todas as escolas", value=True, key="importar_vincular")
+        estoque_inicial = st.number_input("Estoque inicial nas escolas", min_value=0, value=0, key="importar_estoque")
+        
+        if st.button("Importar Produtos", disabled=not linhas):
+            resultado = importar_produtos(linhas, vincular, estoque_inicial)
+            if resultado:
+                st.success(f"{resultado['inseridos']} produto(s) criado(s), {resultado['existentes']} já existente(s), "
+                           f"{resultado['vinculos']} vínculo(s) com escolas criado(s)")
+                if resultado['invalidos']:
+                    st.warning(f"{len(resultado['invalidos'])} linha(s) inválida(s) ignorada(s) "
+                               "(nome, tamanho e preço são obrigatórios)")
 
 def show_order_management():
     st.title("📦 Sistema de Pedidos")
     
-    tab1, tab2 = st.tabs(["Novo Pedido", "Histórico de Pedidos"])
+    aba = selecionar_aba(["Novo Pedido", "Histórico de Pedidos", "Fila de Pedidos"], "aba_pedidos")
     
-    with tab1:
+    if aba == "Novo Pedido":
         st.subheader("Criar Novo Pedido")
         
         clientes = get_clientes()
@@ -911,106 +3630,135 @@ def show_order_management():
             st.warning("Cadastre produtos primeiro para criar pedidos")
             return
         
-        with st.form("novo_pedido"):
-            col1, col2 = st.columns(2)
+        col1, col2 = st.columns(2)
+        with col1:
+            cliente_selecionado = st.selectbox("Cliente *", 
+                                              [f"{c[0]} - {c[1]}" for c in clientes])
+            escola_selecionada = st.selectbox("Escola *", 
+                                             [f"{e[0]} - {e[1]}" for e in escolas])
+        with col2:
+            desconto = st.number_input("Desconto (%)", min_value=0.0, max_value=100.0, value=0.0)
+            usar_fila = st.checkbox("Enviar pela fila (horário de pico)",
+                                    help="O pedido é aceito na hora e gravado no banco em segundo plano")
+        
+        escola_id = int(escola_selecionada.split(' - ')[0])
+        estoque_escola = get_estoque_escola(escola_id)
+        disponivel = {item[7]: item[3] for item in estoque_escola}
+        por_id = {p[0]: p for p in produtos}
+        rotulos = {p[0]: f"{p[0]} - {p[1]} ({p[6]})" for p in produtos if disponivel.get(p[0], 0) > 0}
+        por_rotulo = {rotulo: produto_id for produto_id, rotulo in rotulos.items()}
+        
+        st.subheader("Itens do Pedido")
+        if not rotulos:
+            st.warning("Nenhum produto com estoque nesta escola")
+            return
+        
+        # Linhas iniciais da grade; a geração muda a chave do editor para recomeçar (colagem ou pedido criado).
+        # A chave de idempotência só muda com um pedido criado: cliques repetidos não duplicam o pedido.
+        chave_itens = f"itens_pedido_{escola_id}"
+        if chave_itens not in st.session_state:
+            st.session_state[chave_itens] = (0, [], nova_chave_idempotencia())
+        geracao, linhas_iniciais, chave_pedido = st.session_state[chave_itens]
+        
+        df_itens = st.data_editor(
+            pd.DataFrame(linhas_iniciais, columns=['Produto', 'Quantidade', 'Preço']).astype(
+                {'Produto': 'object', 'Quantidade': 'Int64', 'Preço': 'float'}),
+            num_rows="dynamic",
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'Produto': st.column_config.SelectboxColumn('Produto', options=list(rotulos.values()), width='large'),
+                'Quantidade': st.column_config.NumberColumn('Quantidade', min_value=1, step=1),
+                'Preço': st.column_config.NumberColumn('Preço', min_value=0.0, format="R$ %.2f",
+                                                       help="Em branco: preço do cadastro"),
+            },
+            key=f"grade_itens_{escola_id}_{geracao}"
+        )
+        
+        with st.expander("Colar lista de itens"):
+            st.caption("Uma linha por item: Produto, Tamanho e Quantidade, separados por tabulação ou ponto e vírgula.")
+            texto_itens = st.text_area("Lista", key=f"colar_itens_{escola_id}")
+            if st.button("Adicionar à grade", key=f"adicionar_itens_{escola_id}"):
+                quantidades, invalidas = ler_contagem_planilha(texto_itens, produtos)
+                sem_estoque = [produto_id for produto_id in quantidades if produto_id not in rotulos]
+                linhas = [linha for linha in df_itens.to_dict('records') if not pd.isna(linha['Produto'])]
+                linhas += [{'Produto': rotulos[produto_id], 'Quantidade': quantidade, 'Preço': None}
+                           for produto_id, quantidade in quantidades.items() if quantidade > 0 and produto_id in rotulos]
+                st.session_state[chave_itens] = (geracao + 1, linhas, chave_pedido)
+                if invalidas or sem_estoque:
+                    st.session_state[f"avisos_itens_{escola_id}"] = (
+                        [f"{len(invalidas)} linha(s) não reconhecida(s): " + " | ".join(invalidas[:10])] if invalidas else []
+                    ) + ([f"{len(sem_estoque)} produto(s) sem estoque nesta escola ignorado(s)"] if sem_estoque else [])
+                st.rerun()
+            for aviso in st.session_state.pop(f"avisos_itens_{escola_id}", []):
+                st.warning(aviso)
+        
+        itens = []
+        problemas = []
+        for linha in df_itens.to_dict('records'):
+            if pd.isna(linha['Produto']):
+                continue
+            produto_id = por_rotulo.get(linha['Produto'])
+            if produto_id is None:
+                problemas.append(f"{linha['Produto']}: sem estoque nesta escola")
+            elif pd.isna(linha['Quantidade']) or int(linha['Quantidade']) <= 0:
+                problemas.append(f"{linha['Produto']}: informe a quantidade")
+            else:
+                produto = por_id[produto_id]
+                itens.append({
+                    'produto_id': produto_id,
+                    'quantidade': int(linha['Quantidade']),
+                    'preco': float(produto[3]) if pd.isna(linha['Preço']) else float(linha['Preço']),
+                    'custo': produto[4]
+                })
+        
+        necessario = {}
+        for item in itens:
+            necessario[item['produto_id']] = necessario.get(item['produto_id'], 0) + item['quantidade']
+        problemas += [f"{rotulos[produto_id]}: pedido {quantidade}, disponível {disponivel.get(produto_id, 0)}"
+                      for produto_id, quantidade in necessario.items() if quantidade > disponivel.get(produto_id, 0)]
+        
+        for problema in problemas:
+            st.warning(problema)
+        
+        if itens:
+            st.subheader("Resumo do Pedido")
+            total_venda = sum(item['quantidade'] * item['preco'] for item in itens)
+            total_custo = sum(item['quantidade'] * item['custo'] for item in itens)
+            total_com_desconto = total_venda - (total_venda * desconto / 100)
+            lucro_total = total_com_desconto - total_custo
+            margem_lucro = (lucro_total / total_com_desconto * 100) if total_com_desconto > 0 else 0
             
+            col1, col2, col3, col4 = st.columns(4)
             with col1:
-                cliente_selecionado = st.selectbox("Cliente *", 
-                                                  [f"{c[0]} - {c[1]}" for c in clientes])
-                escola_selecionada = st.selectbox("Escola *", 
-                                                 [f"{e[0]} - {e[1]}" for e in escolas])
-                desconto = st.number_input("Desconto (%)", min_value=0.0, max_value=100.0, value=0.0)
-            
-            st.subheader("Itens do Pedido")
-            
-            itens = []
-            if escola_selecionada:
-                escola_id = int(escola_selecionada.split(' - ')[0])
-                estoque_escola = get_estoque_escola(escola_id)
-            
-            for i in range(3):
-                col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-                with col1:
-                    produtos_com_estoque = []
-                    for produto in produtos:
-                        estoque_disponivel = 0
-                        for item in estoque_escola:
-                            if item[7] == produto[0]:
-                                estoque_disponivel = item[3]
-                                break
-                        
-                        if estoque_disponivel > 0:
-                            produtos_com_estoque.append(produto)
-                    
-                    if produtos_com_estoque:
-                        produto_opcoes = [f"{p[0]} - {p[1]} ({p[6]}) - Estoque: {next((item[3] for item in estoque_escola if item[7] == p[0]), 0)}" 
-                                         for p in produtos_com_estoque]
-                        produto_selecionado = st.selectbox(f"Produto {i+1}", [""] + produto_opcoes, key=f"prod_{i}")
-                    else:
-                        st.warning("Nenhum produto com estoque")
-                        produto_selecionado = None
-                
-                with col2:
-                    if produto_selecionado:
-                        produto_id = int(produto_selecionado.split(' - ')[0])
-                        estoque_disponivel = next((item[3] for item in estoque_escola if item[7] == produto_id), 0)
-                        quantidade = st.number_input(f"Qtd {i+1}", min_value=1, max_value=estoque_disponivel, value=1, key=f"qtd_{i}")
-                    else:
-                        quantidade = 0
-                
-                with col3:
-                    if produto_selecionado:
-                        produto_info = next(p for p in produtos if p[0] == produto_id)
-                        preco = st.number_input(f"Preço {i+1}", min_value=0.0, value=float(produto_info[3]), key=f"preco_{i}")
-                        custo = produto_info[4]
-                    else:
-                        preco = 0.0
-                        custo = 0.0
-                
-                with col4:
-                    if produto_selecionado and preco > 0 and custo > 0:
-                        lucro_unitario = preco - custo
-                        margem = (lucro_unitario / preco * 100) if preco > 0 else 0
-                        st.write(f"Margem: {margem:.1f}%")
-                
-                if produto_selecionado and quantidade > 0:
-                    itens.append({
-                        'produto_id': produto_id,
-                        'quantidade': quantidade,
-                        'preco': preco,
-                        'custo': custo
-                    })
-            
-            if itens:
-                st.subheader("Resumo do Pedido")
-                total_venda = sum(item['quantidade'] * item['preco'] for item in itens)
-                total_custo = sum(item['quantidade'] * item['custo'] for item in itens)
-                total_com_desconto = total_venda - (total_venda * desconto / 100)
-                lucro_total = total_com_desconto - total_custo
-                margem_lucro = (lucro_total / total_com_desconto * 100) if total_com_desconto > 0 else 0
+                st.metric("Total Venda", f"R$ {total_venda:.2f}")
+            with col2:
+                st.metric("Total com Desconto", f"R$ {total_com_desconto:.2f}")
+            with col3:
+                st.metric("Lucro Total", f"R$ {lucro_total:.2f}")
+            with col4:
+                st.metric("Margem", f"{margem_lucro:.1f}%")
+            st.caption(f"{len(itens)} linha(s), {sum(necessario.values())} peça(s)")
+        
+        if st.button("Criar Pedido", type="primary", disabled=bool(problemas)):
+            if not itens:
+                st.error("Adicione pelo menos um item ao pedido")
+            else:
+                cliente_id = int(cliente_selecionado.split(' - ')[0])
                 
-                col1, col2, col3, col4 = st.columns(4)
-                with col1:
-                    st.metric("Total Venda", f"R$ {total_venda:.2f}")
-                with col2:
-                    st.metric("Total com Desconto", f"R$ {total_com_desconto:.2f}")
-                with col3:
-                    st.metric("Lucro Total", f"R$ {lucro_total:.2f}")
-                with col4:
-                    st.metric("Margem", f"{margem_lucro:.1f}%")
-            
-            if st.form_submit_button("Criar Pedido"):
-                if not itens:
-                    st.error("Adicione pelo menos um item ao pedido")
+                if usar_fila:
+                    fila_id = enfileirar_pedido(cliente_id, escola_id, itens, desconto, chave=chave_pedido)
+                    if fila_id:
+                        st.success(f"Pedido aceito na fila (#{fila_id}). Acompanhe em Fila de Pedidos.")
+                        st.session_state[chave_itens] = (geracao + 1, [], nova_chave_idempotencia())
                 else:
-                    cliente_id = int(cliente_selecionado.split(' - ')[0])
-                    escola_id = int(escola_selecionada.split(' - ')[0])
-                    
-                    pedido_id = add_pedido(cliente_id, escola_id, itens, desconto)
+                    pedido_id = add_pedido(cliente_id, escola_id, itens, desconto, verificar_estoque=True,
+                                           chave=chave_pedido)
                     if pedido_id:
                         st.success(f"Pedido #{pedido_id} criado com sucesso!")
+                        st.session_state[chave_itens] = (geracao + 1, [], nova_chave_idempotencia())
     
-    with tab2:
+    if aba == "Histórico de Pedidos":
         st.subheader("Histórico de Pedidos")
         pedidos = get_pedidos()
         
@@ -1032,28 +3780,49 @@ def show_order_management():
                 st.write("**Alterar Status:**")
                 col1, col2, col3, col4 = st.columns(4)
                 with col1:
-                    if st.button("✅ Confirmar", key=f"confirm_{pedido[0]}"):
-                        update_pedido_status(pedido[0], "Confirmado")
+                    if st.button("✅ Confirmar", key=f"confirm_{pedido[2]}_{pedido[0]}"):
+                        update_pedido_status(pedido[0], "Confirmado", pedido[2])
                         st.rerun()
                 with col2:
-                    if st.button("🚚 Enviar", key=f"enviar_{pedido[0]}"):
-                        update_pedido_status(pedido[0], "Enviado")
+                    if st.button("🚚 Enviar", key=f"enviar_{pedido[2]}_{pedido[0]}"):
+                        update_pedido_status(pedido[0], "Enviado", pedido[2])
                         st.rerun()
                 with col3:
-                    if st.button("📦 Entregue", key=f"entregue_{pedido[0]}"):
-                        update_pedido_status(pedido[0], "Entregue")
+                    if st.button("📦 Entregue", key=f"entregue_{pedido[2]}_{pedido[0]}"):
+                        update_pedido_status(pedido[0], "Entregue", pedido[2])
                         st.rerun()
                 with col4:
-                    if st.button("❌ Cancelar", key=f"cancelar_{pedido[0]}"):
-                        update_pedido_status(pedido[0], "Cancelado")
+                    if st.button("❌ Cancelar", key=f"cancelar_{pedido[2]}_{pedido[0]}"):
+                        update_pedido_status(pedido[0], "Cancelado", pedido[2])
                         st.rerun()
+    
+    if aba == "Fila de Pedidos":
+        st.subheader("Fila de Pedidos")
+        fila = get_fila_pedidos()
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Aguardando envio", fila.pendentes())
+        with col2:
+            if st.button("🔄 Atualizar"):
+                fila.evento.set()
+                st.rerun()
+        
+        entradas = fila.listar()
+        if not entradas:
+            st.info("Nenhum pedido enviado pela fila")
+        else:
+            st.dataframe(pd.DataFrame(
+                [(e[0], e[1], e[2], e[3], e[4], e[5], e[6]) for e in entradas],
+                columns=["Fila", "Status", "Pedido", "Erro", "Tentativas", "Recebido em", "Processado em"]
+            ), hide_index=True, use_container_width=True)
 
 def show_reports():
     st.title("📈 Relatórios e Análises")
     
-    tab1, tab2 = st.tabs(["Exportar Dados", "Análise Financeira"])
+    aba = selecionar_aba(["Exportar Dados", "Análise Financeira", "Extratos por Escola"], "aba_relatorios")
     
-    with tab1:
+    if aba == "Exportar Dados":
         st.subheader("Exportar Dados")
         
         col1, col2, col3 = st.columns(3)
@@ -1069,8 +3838,9 @@ def show_reports():
                 st.download_button("Baixar CSV", output.getvalue(), "clientes.csv", "text/csv")
         
         with col2:
+            incluir_arquivo = st.checkbox("Incluir pedidos arquivados")
             if st.button("Exportar Pedidos CSV"):
-                pedidos = get_pedidos()
+                pedidos = get_pedidos(incluir_arquivo=incluir_arquivo)
                 output = StringIO()
                 writer = csv.writer(output)
                 writer.writerow(['ID', 'Cliente_ID', 'Escola_ID', 'Status', 'Total', 'Desconto', 'Custo_Total', 'Lucro_Total', 'Margem_Lucro', 'Data', 'Cliente_Nome', 'Escola_Nome'])
@@ -1087,13 +3857,76 @@ def show_reports():
                 for produto in produtos:
                     writer.writerow(produto)
                 st.download_button("Baixar CSV", output.getvalue(), "produtos.csv", "text/csv")
+        
+        st.markdown("---")
+        st.subheader("Exportação Incremental")
+        st.caption("Exporta apenas as linhas alteradas ou excluídas desde a última exportação deste consumidor. "
+                   f"Alterações dos últimos {TRANSACAO_DURACAO_MAXIMA} segundos ficam para a próxima exportação.")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            consumidor = st.text_input("Consumidor", value="contabilidade")
+        with col2:
+            tabela = st.selectbox("Tabela", list(TABELAS_RASTREADAS.keys()))
+        
+        if consumidor:
+            watermark = get_watermark(consumidor, tabela)
+            st.write(f"**Última exportação:** {format_date_br(watermark) if watermark else 'Nunca (exportação completa)'}")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Exportar Alterações CSV"):
+                if not consumidor:
+                    st.error("Informe o consumidor")
+                else:
+                    exportacao = exportar_alteracoes(consumidor, tabela)
+                    if exportacao:
+                        conteudo, alteradas, excluidas, desde, ate = exportacao
+                        st.success(f"{alteradas} linha(s) alterada(s) e {excluidas} exclusão(ões) até {format_date_br(ate)}")
+                        st.download_button("Baixar CSV", conteudo,
+                                           f"{tabela}_{ate.strftime('%Y%m%d%H%M%S')}.csv", "text/csv")
+        with col2:
+            if st.button("Reiniciar Cursor"):
+                chaves = {tabela} | {chave for _, chave in cursores_exportacao(tabela)}
+                if consumidor and all(set_watermark(consumidor, chave, None) for chave in chaves):
+                    st.success("Cursor reiniciado. A próxima exportação será completa.")
+    
+    if aba == "Extratos por Escola":
+        st.subheader("Extratos por Escola")
+        st.caption("Um extrato por escola (CSV e HTML para impressão) com pedidos, itens, totais e estoque.")
+        
+        escolas = get_escolas()
+        col1, col2 = st.columns(2)
+        with col1:
+            inicio = st.date_input("Início do período", value=date.today() - timedelta(days=180))
+        with col2:
+            fim = st.date_input("Fim do período", value=date.today())
+        selecionadas = st.multiselect("Escolas (vazio = todas)", [f"{e[0]} - {e[1]}" for e in escolas])
+        
+        if st.button("Gerar Extratos"):
+            ids = {int(s.split(' - ')[0]) for s in selecionadas}
+            alvo = [e for e in escolas if not ids or e[0] in ids]
+            if not alvo:
+                st.error("Nenhuma escola cadastrada")
+            else:
+                with st.spinner(f"Gerando extratos de {len(alvo)} escola(s)..."):
+                    arquivo = gerar_extratos_escolas(
+                        alvo,
+                        datetime.combine(inicio, datetime.min.time()),
+                        datetime.combine(fim + timedelta(days=1), datetime.min.time())
+                    )
+                if arquivo:
+                    st.success(f"{len(alvo)} extrato(s) gerado(s)")
+                    st.download_button("Baixar Extratos (.zip)", arquivo,
+                                       f"extratos_{inicio.strftime('%Y%m%d')}_{fim.strftime('%Y%m%d')}.zip",
+                                       "application/zip")
 
 def show_ai_system():
     st.title("🤖 Sistema A.I. Inteligente")
     
-    tab1, tab2 = st.tabs(["📈 Previsões de Vendas", "⚠️ Alertas Automáticos"])
+    aba = selecionar_aba(["📈 Previsões de Vendas", "⚠️ Alertas Automáticos", "🛒 Plano de Reposição"], "aba_ia")
     
-    with tab1:
+    if aba == "📈 Previsões de Vendas":
         st.subheader("Previsões de Vendas")
         meses, vendas = previsao_vendas()
         
@@ -1102,7 +3935,7 @@ def show_ai_system():
             st.write(f"- **{mes}:** R$ {venda:,.2f}")
             st.progress(min(venda / 50000, 1.0))
     
-    with tab2:
+    if aba == "⚠️ Alertas Automáticos":
         st.subheader("Alertas de Estoque")
         alertas = alertas_estoque()
         
@@ -1117,6 +3950,31 @@ def show_ai_system():
                 """)
         else:
             st.success("✅ Nenhum alerta de estoque baixo no momento")
+    
+    if aba == "🛒 Plano de Reposição":
+        st.subheader("Plano de Reposição")
+        st.caption("Velocidade de vendas e curva de tamanhos por escola, projetadas para o período de cobertura.")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            dias_historico = st.number_input("Histórico de vendas (dias)", min_value=7, value=90)
+        with col2:
+            dias_cobertura = st.number_input("Cobertura desejada (dias)", min_value=1, value=30)
+        
+        plano, lista_compra = planejar_reposicao(dias_historico, dias_cobertura)
+        
+        if not plano:
+            st.success("✅ Nenhuma reposição necessária para o período")
+        else:
+            st.write("**Lista de Compra Consolidada**")
+            df_compra = pd.DataFrame(lista_compra)
+            st.dataframe(df_compra, hide_index=True, use_container_width=True)
+            st.metric("Custo Estimado", f"R$ {df_compra['Custo estimado'].sum():,.2f}")
+            st.download_button("Baixar Lista de Compra CSV", df_compra.to_csv(index=False),
+                               "lista_compra.csv", "text/csv")
+            
+            st.write("**Sugestão por Escola**")
+            st.dataframe(pd.DataFrame(plano), hide_index=True, use_container_width=True)
 
 def show_admin_panel():
     if st.session_state.user[3] != 'admin':
@@ -1125,9 +3983,12 @@ def show_admin_panel():
         
     st.title("🔐 Painel de Administração")
     
-    tab1, tab2 = st.tabs(["Gerenciar Usuários", "Backup de Dados"])
+    opcoes = ["Gerenciar Usuários", "Backup de Dados", "Arquivamento", "Auditoria", "Perfil de Páginas"]
+    if shard_engines:
+        opcoes.append("Shards")
+    aba = selecionar_aba(opcoes, "aba_admin")
     
-    with tab1:
+    if aba == "Gerenciar Usuários":
         st.subheader("Gerenciar Usuários")
         
         with st.form("novo_usuario"):
@@ -1158,6 +4019,151 @@ def show_admin_panel():
                 st.write(f"ID: {usuario[0]}")
                 st.write(f"Nível: {usuario[2]}")
                 st.write(f"Criado em: {format_date_br(usuario[3])}")
+    
+    if aba == "Backup de Dados":
+        st.subheader("Backup de Dados")
+        
+        tipo_backup = st.radio("Tipo de backup", ["Completo", "Incremental"], horizontal=True,
+                               help="O incremental inclui apenas o que mudou desde o último backup")
+        
+        if st.button("Gerar Backup"):
+            with st.spinner("Gerando backup..."):
+                backup = gerar_backup(incremental=tipo_backup == "Incremental")
+            if backup:
+                caminho, checksum = backup
+                st.success(f"Backup gerado: {os.path.basename(caminho)}")
+                st.code(f"SHA-256: {checksum}")
+        
+        backups = listar_backups()
+        if backups:
+            backup_selecionado = st.selectbox("Backups disponíveis", backups)
+            with open(os.path.join(BACKUP_DIR, backup_selecionado), 'rb') as arquivo:
+                st.download_button("Baixar Backup", arquivo, backup_selecionado, "application/zip")
+        
+        st.markdown("---")
+        st.subheader("Restaurar Backup")
+        st.warning("A restauração de um backup completo substitui todos os dados atuais.")
+        
+        arquivo_backup = st.file_uploader("Arquivo de backup (.zip)", type=["zip"])
+        confirmar = st.checkbox("Confirmo que desejo restaurar este backup")
+        
+        if st.button("Restaurar Backup"):
+            if not arquivo_backup:
+                st.error("Selecione um arquivo de backup")
+            elif not confirmar:
+                st.error("Confirme a restauração")
+            else:
+                with st.spinner("Restaurando backup..."):
+                    if restaurar_backup(arquivo_backup):
+                        st.success("Backup restaurado com sucesso!")
+    
+    if aba == "Arquivamento":
+        st.subheader("Arquivamento de Pedidos")
+        st.caption("Move pedidos Entregues/Cancelados antigos para as tabelas de arquivo, "
+                   "mantendo as telas do dia a dia apenas com a temporada atual.")
+        
+        dias = st.number_input("Arquivar pedidos finalizados com mais de (dias)",
+                               min_value=30, value=ARQUIVO_DIAS)
+        st.write(f"**Pedidos elegíveis:** {contar_pedidos_arquivaveis(dias)}")
+        
+        if st.button("Arquivar Pedidos"):
+            with st.spinner("Arquivando pedidos..."):
+                arquivados = arquivar_pedidos(dias)
+            st.success(f"{arquivados} pedido(s) arquivado(s)")
+    
+    if aba == "Auditoria":
+        st.subheader("Log de Auditoria")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            usuario_filtro = st.selectbox("Usuário", ["Todos"] + [u[1] for u in get_usuarios()])
+        with col2:
+            entidade_filtro = st.selectbox("Entidade", ["Todas", "pedidos", "clientes", "escolas", "produtos",
+                                                        "estoque_escolas", "usuarios"])
+        with col3:
+            inicio = st.date_input("De", value=date.today() - timedelta(days=7))
+        with col4:
+            fim = st.date_input("Até", value=date.today())
+        entidade_id = st.number_input("ID da entidade (0 = todos)", min_value=0, value=0)
+        
+        registros = get_auditoria(
+            usuario=None if usuario_filtro == "Todos" else usuario_filtro,
+            entidade=None if entidade_filtro == "Todas" else entidade_filtro,
+            entidade_id=entidade_id or None,
+            inicio=datetime.combine(inicio, datetime.min.time()),
+            fim=datetime.combine(fim + timedelta(days=1), datetime.min.time())
+        )
+        
+        if not registros:
+            st.info("Nenhum registro no período")
+        else:
+            st.dataframe(pd.DataFrame(
+                [(format_date_br(r[0]), r[1], r[2], r[3], r[4], r[5]) for r in registros],
+                columns=["Data", "Usuário", "Ação", "Entidade", "ID", "Detalhes"]
+            ), hide_index=True, use_container_width=True)
+    
+    if aba == "Perfil de Páginas":
+        st.subheader("Perfil de Páginas")
+        st.caption("Ative \"🔬 Perfilar páginas\" na barra lateral para medir cada rerun da página aberta "
+                   f"(mantidos os {PERFIL_EXECUCOES} mais recentes deste servidor).")
+        
+        perfis = list(get_perfis())[::-1]
+        if not perfis:
+            st.info("Nenhum rerun perfilado ainda")
+        else:
+            st.dataframe(pd.DataFrame(
+                [(format_date_br(p['inicio']), p['pagina'], p['usuario'], round(p['duracao'], 3), p['widgets'])
+                 for p in perfis],
+                columns=["Data", "Página", "Usuário", "Tempo (s)", "Widgets"]
+            ), hide_index=True, use_container_width=True)
+            
+            indice = st.selectbox("Rerun", range(len(perfis)),
+                                  format_func=lambda i: f"{format_date_br(perfis[i]['inicio'])} - {perfis[i]['pagina']} "
+                                                        f"({perfis[i]['duracao']:.3f}s)")
+            perfil = perfis[indice]
+            
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                st.write("**Tempo próprio por camada (s)**")
+                st.dataframe(pd.Series(perfil['camadas'], name="Tempo (s)").sort_values(ascending=False).round(4),
+                             use_container_width=True)
+            with col2:
+                st.write("**Maior tempo acumulado**")
+                st.dataframe(pd.DataFrame(perfil['pontos_quentes'],
+                                          columns=["Função", "Chamadas", "Próprio (s)", "Acumulado (s)"]).round(4),
+                             hide_index=True, use_container_width=True)
+            
+            nome_arquivo = f"perfil_{perfil['inicio'].strftime('%Y%m%d_%H%M%S')}.prof"
+            st.download_button("Baixar .prof", perfil['prof'], nome_arquivo, "application/octet-stream")
+            st.caption("Abra com `python -m pstats` ou snakeviz.")
+            
+            if st.button("Limpar Perfis"):
+                get_perfis().clear()
+                st.rerun()
+    
+    if aba == "Shards":
+        st.subheader("Shards por Escola")
+        st.caption("Pedidos e estoque de cada escola ficam no shard escola_id % N; clientes, escolas e "
+                   "produtos são replicados do banco principal.")
+        
+        escolas = get_escolas()
+        st.dataframe(pd.DataFrame([{
+            'Shard': shard,
+            'Banco': shard_engines[shard].url.render_as_string(hide_password=True),
+            'Escolas': sum(1 for escola in escolas if shard_da_escola(escola[0]) == shard),
+        } for shard in range(len(shard_engines))]), hide_index=True, use_container_width=True)
+        
+        pendentes = executar_leitura(select(func.count()).select_from(ReplicacaoPendente), primario=True)[0][0]
+        if pendentes:
+            st.warning(f"{pendentes} replicação(ões) para os shards falharam e aguardam a sincronização.")
+        
+        if st.button("Sincronizar Shards"):
+            try:
+                with st.spinner("Copiando clientes, escolas e produtos para os shards..."):
+                    refeitas = sincronizar_shards()
+                st.success(f"Shards sincronizados! {refeitas} replicação(ões) pendente(s) refeita(s).")
+            except Exception as e:
+                st.error(f"Erro ao sincronizar shards: {e}")
 
 if __name__ == "__main__":
     main()